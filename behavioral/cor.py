@@ -6,6 +6,12 @@ Launch-and-leave requests with a single processing pipeline that contains many p
 An object-oriented linked list with recursive traversal.
 """
 import abc
+import asyncio
+import itertools
+import sys
+import timeit
+import weakref
+from collections import Counter
 from enum import Enum
 
 """
@@ -24,40 +30,313 @@ class Severity(Enum):
 
 
 class Handler(metaclass=abc.ABCMeta):
+    # The severity this handler owns. Used to build the lookup table of a CompiledChain; a handler
+    # without one is left to handle the requests reaching it by itself.
+    severity = None
+    # Whether the linked walk ends at this handler, whatever the request.
+    terminal = False
+
     def __init__(self, successor=None):
+        # The compiled chains this handler is part of, to be rebuilt when its successor changes.
+        self.chains = weakref.WeakSet()
         self.successor = successor
 
+    @property
+    def successor(self):
+        return self._successor
+
+    @successor.setter
+    def successor(self, successor):
+        self._successor = successor
+        if self.chains:
+            for chain in list(self.chains):
+                chain.invalidate()
+
     @abc.abstractmethod
     def handle(self, severity):
         raise NotImplementedError("Please implement the method.")
 
+    def process(self, severity):
+        """
+        The result of a request this handler owns. Defaults to handling it.
+        """
+        return self.handle(severity)
+
+    def process_batch(self, severities):
+        """
+        Handle a group of requests owned by this handler in one call. Override it when the handler
+        can do better than processing the requests one by one.
+        """
+        return [self.process(severity) for severity in severities]
+
+    def handle_many(self, severities, batch_size=1024):
+        """
+        Stream the requests through the chain starting at this handler. See CompiledChain.handle_many.
+        """
+        return CompiledChain(self).handle_many(severities, batch_size)
+
 
 class DeveloperHandler(Handler):
+    severity = Severity.LOW
 
     def handle(self, severity):
-        if severity == Severity.LOW:
-            print("Developer handled the issue. Please do not escalate.")
+        if severity == self.severity:
+            print(self.process(severity))
         elif self.successor:
             self.successor.handle(severity)
 
+    def process(self, severity):
+        return "Developer handled the issue. Please do not escalate."
+
 
 class ManagerHandler(Handler):
+    severity = Severity.HIGH
 
     def handle(self, severity):
-        if severity == Severity.HIGH:
-            print("Manager handled the issue. Please do not escalate.")
+        if severity == self.severity:
+            print(self.process(severity))
         elif self.successor:
             self.successor.handle(severity)
 
+    def process(self, severity):
+        return "Manager handled the issue. Please do not escalate."
+
 
 class VicePresidentHandler(Handler):
+    severity = Severity.CRITICAL
+    terminal = True
 
     def handle(self, severity):
-        if severity == Severity.CRITICAL:
-            print("VP handled the issue.")
+        if severity == self.severity:
+            print(self.process(severity))
         else:
             print("We are sorry !")
 
+    def process(self, severity):
+        return "VP handled the issue."
+
+
+class CompiledChain:
+    """
+    Flattens the successor links of a chain into a severity -> handler table, so a request is
+    dispatched with one lookup instead of a (recursive) walk down the chain.
+    The flattening stops at a terminal handler, and at a handler without a severity: that one becomes
+    the fallback that handles every request not owned before it, walking the rest of the chain itself.
+    The table is rebuilt lazily once a successor link of one of its handlers has changed.
+    """
+
+    def __init__(self, head):
+        self.head = head
+        self.table = {}
+        self.fallback = None
+        self.compiled = False
+
+    def compile(self):
+        table = {}
+        fallback = None
+        seen = set()
+        handler = self.head
+        while handler is not None and id(handler) not in seen:
+            seen.add(id(handler))
+            handler.chains.add(self)
+            if handler.severity is None:
+                fallback = handler
+                break
+            # The first handler in the chain owning a severity wins, same as the linked walk.
+            if handler.severity not in table:
+                table[handler.severity] = handler
+            if handler.terminal:
+                break
+            handler = handler.successor
+        self.table = table
+        self.fallback = fallback
+        self.compiled = True
+
+    def invalidate(self):
+        self.compiled = False
+
+    def dispatch(self, severity):
+        if not self.compiled:
+            self.compile()
+        handler = self.table.get(severity)
+        if handler is not None:
+            return handler.process(severity)
+        if self.fallback is not None:
+            return self.fallback.handle(severity)
+        return "We are sorry !"
+
+    def handle(self, severity):
+        result = self.dispatch(severity)
+        # A fallback handler prints its own results.
+        if result is not None:
+            print(result)
+
+    def handle_many(self, severities, batch_size=1024):
+        """
+        Generator pipeline for a (possibly unbounded) stream of requests.
+        Reads at most batch_size requests at a time, groups them by the handler owning them and runs
+        every handler once per batch. Yields a dict of handler -> list of results per batch; requests
+        nobody owns are grouped under None, or under the fallback handler, which handles them one by one.
+        Only one batch is held in memory at any time.
+        """
+        severities = iter(severities)
+        while True:
+            batch = list(itertools.islice(severities, batch_size))
+            if not batch:
+                return
+            if not self.compiled:
+                self.compile()
+            groups = {}
+            for severity in batch:
+                groups.setdefault(self.table.get(severity, self.fallback), []).append(severity)
+            report = {}
+            for handler, owned in groups.items():
+                if handler is None:
+                    report[None] = ["We are sorry !"] * len(owned)
+                elif handler is self.fallback:
+                    report[handler] = [handler.handle(severity) for severity in owned]
+                else:
+                    report[handler] = handler.process_batch(owned)
+            yield report
+
+
+def tally(reports):
+    """
+    Fold the reports of handle_many into per-handler counts without keeping the results around.
+    """
+    counts = Counter()
+    for report in reports:
+        for handler, results in report.items():
+            counts[type(handler).__name__ if handler is not None else None] += len(results)
+    return counts
+
+
+class AsyncHandler(metaclass=abc.ABCMeta):
+    """
+    Asynchronous variant of Handler for tiers that call out to slow external systems.
+    At most `concurrency` requests are processed by a tier at the same time; further requests wait
+    for a free slot, which pushes back on the callers while the tier is saturated. A request that
+    is not done within `timeout` seconds (waiting included) is escalated to the successor.
+    """
+    severity = None
+
+    def __init__(self, successor=None, concurrency=1, timeout=None):
+        self.successor = successor
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self._semaphore = None
+        self._loop = None
+
+    @property
+    def semaphore(self):
+        # A semaphore is bound to the event loop it is first used on: one per loop, rebuilt when the
+        # handler is used from another loop (e.g. a second asyncio.run).
+        loop = asyncio.get_running_loop()
+        if self._semaphore is None or self._loop is not loop:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+            self._loop = loop
+        return self._semaphore
+
+    @property
+    def saturated(self):
+        return self._semaphore is not None and self._semaphore.locked()
+
+    async def handle(self, severity):
+        if severity == self.severity:
+            return await self.run(severity)
+        elif self.successor:
+            return await self.successor.handle(severity)
+        return "We are sorry !"
+
+    async def handle_all(self, severities):
+        return await asyncio.gather(*[self.handle(severity) for severity in severities])
+
+    async def run(self, severity):
+        try:
+            return await asyncio.wait_for(self._run(severity), self.timeout)
+        except asyncio.TimeoutError:
+            if self.successor:
+                return await self.successor.run(severity)
+            return "We are sorry !"
+
+    async def _run(self, severity):
+        async with self.semaphore:
+            return await self.process(severity)
+
+    @abc.abstractmethod
+    async def process(self, severity):
+        raise NotImplementedError("Please implement the method.")
+
+
+class AsyncDeveloperHandler(AsyncHandler):
+    severity = Severity.LOW
+
+    def __init__(self, successor=None, concurrency=1, timeout=None, delay=0):
+        super().__init__(successor, concurrency, timeout)
+        self.delay = delay
+
+    async def process(self, severity):
+        await asyncio.sleep(self.delay)
+        return "Developer handled the issue. Please do not escalate."
+
+
+class AsyncManagerHandler(AsyncHandler):
+    severity = Severity.HIGH
+
+    def __init__(self, successor=None, concurrency=1, timeout=None, delay=0):
+        super().__init__(successor, concurrency, timeout)
+        self.delay = delay
+
+    async def process(self, severity):
+        await asyncio.sleep(self.delay)
+        return "Manager handled the issue. Please do not escalate."
+
+
+class AsyncVicePresidentHandler(AsyncHandler):
+    severity = Severity.CRITICAL
+
+    def __init__(self, successor=None, concurrency=1, timeout=None, delay=0):
+        super().__init__(successor, concurrency, timeout)
+        self.delay = delay
+
+    async def process(self, severity):
+        await asyncio.sleep(self.delay)
+        return "VP handled the issue."
+
+
+class _BenchmarkHandler(Handler):
+
+    def __init__(self, severity, successor=None):
+        super().__init__(successor)
+        self.severity = severity
+
+    def handle(self, severity):
+        if severity == self.severity:
+            return self.process(severity)
+        elif self.successor:
+            return self.successor.handle(severity)
+
+    def process(self, severity):
+        return None
+
+
+def benchmark_dispatch(lengths=(3, 10, 100, 1000, 10000), number=1000):
+    """
+    Compare the linked walk against the compiled table for a request owned by the last handler.
+    """
+    for length in lengths:
+        head = None
+        for severity in range(length, 0, -1):
+            head = _BenchmarkHandler(severity, head)
+        chain = CompiledChain(head)
+        chain.compile()
+        try:
+            linked = "{:.2f} us".format(timeit.timeit(lambda: head.handle(length), number=number) / number * 1e6)
+        except RecursionError:
+            linked = "RecursionError (limit {})".format(sys.getrecursionlimit())
+        table = timeit.timeit(lambda: chain.dispatch(length), number=number) / number * 1e6
+        print("Chain length: {:>6} linked walk: {:>28} table dispatch: {:.2f} us".format(length, linked, table))
+
 
 if __name__ == '__main__':
     low = Severity.LOW
@@ -71,3 +350,19 @@ if __name__ == '__main__':
     dev.handle(high)
     dev.handle(critical)
     dev.handle(invalid)
+    print("--- Compiled chain ---")
+    chain = CompiledChain(dev)
+    for severity in (low, high, critical, invalid):
+        chain.handle(severity)
+    print("--- Batched ---")
+    for report in dev.handle_many([low, critical, low, invalid, high, low], batch_size=4):
+        print({type(handler).__name__ if handler else None: results for handler, results in report.items()})
+    print(tally(dev.handle_many(itertools.islice(itertools.cycle(Severity), 100000))))
+    print("--- Async ---")
+    async_vp = AsyncVicePresidentHandler(concurrency=2, delay=0.01)
+    async_manager = AsyncManagerHandler(async_vp, concurrency=1, timeout=0.05, delay=0.02)
+    async_dev = AsyncDeveloperHandler(async_manager, concurrency=2, delay=0.01)
+    # The manager can only take one request at a time, so the later HIGH bugs time out and go to the VP.
+    for result in asyncio.run(async_dev.handle_all([low, high, high, high, critical, invalid])):
+        print(result)
+    benchmark_dispatch()
@@ -3,6 +3,15 @@ Define a one-to-many dependency between objects so that when one object
 changes state, all its dependents are notified and updated automatically.
 """
 import abc
+import asyncio
+import itertools
+import math
+import threading
+import time
+import timeit
+import weakref
+from array import array
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 """
 Use case:
@@ -29,6 +38,10 @@ class Observable(metaclass=abc.ABCMeta):
 
 
 class Observer(metaclass=abc.ABCMeta):
+    # The weather fields the observer cares about. None means every update, changed or not.
+    fields = None
+    # Dead-band: a subscribed field only triggers an update once it moved by more than this.
+    threshold = 0
 
     @abc.abstractmethod
     def update(self, temp, pressure, humidity):
@@ -43,41 +56,443 @@ class Display(metaclass=abc.ABCMeta):
 
 
 # Concrete classes
-class Weather(Observable):
+class ObserverRegistry:
+    """
+    Insertion ordered set of weakly referenced observers with O(1) add and remove.
+    An observer that gets garbage collected drops out of the registry on its own.
+    """
 
     def __init__(self, observers=None):
+        self._refs = {}
+        for observer in observers or ():
+            self.add(observer)
+
+    def add(self, observer, data=None):
+        """
+        Register the observer, optionally with some data that is handed back by items().
+        """
+        key = id(observer)
+        if key not in self._refs:
+            refs = self._refs
+
+            def discard(ref):
+                if key in refs and refs[key][0] is ref:
+                    del refs[key]
+
+            refs[key] = (weakref.ref(observer, discard), data)
+
+    def remove(self, observer):
+        if observer not in self:
+            raise ValueError("Observer is not registered.")
+        del self._refs[id(observer)]
+
+    def get(self, observer):
+        return self._refs[id(observer)][1] if observer in self else None
+
+    def __contains__(self, observer):
+        entry = self._refs.get(id(observer))
+        return entry is not None and entry[0]() is observer
+
+    def __len__(self):
+        return len(self._refs)
+
+    def __iter__(self):
+        for observer, _ in self.items():
+            yield observer
+
+    def items(self):
+        # Iterate over a copy so that observers may (un)register while being notified.
+        for ref, data in list(self._refs.values()):
+            observer = ref()
+            if observer is not None:
+                yield observer, data
+
+
+class Subscription:
+    """
+    What an observer subscribed to, and the field values it was last notified with.
+    """
+    __slots__ = ('order', 'fields', 'threshold', 'last')
+
+    def __init__(self, order, fields, threshold=0):
+        self.order = order
+        self.fields = tuple(fields)
+        self.threshold = threshold
+        self.last = dict.fromkeys(self.fields)
+
+    def is_due(self, field, value):
+        last = self.last[field]
+        if last is None or value is None:
+            return last != value
+        if self.threshold:
+            return abs(value - last) > self.threshold
+        return value != last
+
+
+class NotificationScheduler:
+    """
+    Delivers observer updates on a background thread so that ingestion never waits on a display.
+    Updates pending for the same observer are coalesced to the latest one, and every observer is
+    updated at most max_rate times per second (no limit when max_rate is None).
+    """
+
+    def __init__(self, max_rate=None):
+        self.min_interval = 1.0 / max_rate if max_rate else 0
+        self.pending = {}
+        self.next_due = {}
+        self.condition = threading.Condition()
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        with self.condition:
+            if self.running:
+                return
+            self.running = True
+        self.thread = threading.Thread(target=self._run, name="NotificationScheduler", daemon=True)
+        self.thread.start()
+
+    def stop(self, flush=True):
+        """
+        Stop the delivery thread. With flush, the pending updates are delivered first, ignoring the rate.
+        """
+        with self.condition:
+            self.running = False
+            if not flush:
+                self.pending.clear()
+            self.condition.notify()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def submit(self, observer, *args):
+        with self.condition:
+            # Replaces whatever was still pending for the observer: only the latest value matters.
+            self.pending[id(observer)] = (observer, args)
+            self.condition.notify()
+
+    def _ready(self, now):
+        if not self.running:
+            return list(self.pending)
+        return [key for key in self.pending if self.next_due.get(key, 0) <= now]
+
+    def _run(self):
+        while True:
+            with self.condition:
+                now = time.monotonic()
+                ready = self._ready(now)
+                while not ready and self.running:
+                    waits = [self.next_due[key] - now for key in self.pending if key in self.next_due]
+                    self.condition.wait(min(waits) if waits else None)
+                    now = time.monotonic()
+                    ready = self._ready(now)
+                if not ready and not self.running:
+                    return
+                batch = [self.pending.pop(key) for key in ready]
+                for key in [key for key, due in self.next_due.items() if due <= now and key not in self.pending]:
+                    del self.next_due[key]
+            for observer, args in batch:
+                if self.min_interval:
+                    self.next_due[id(observer)] = time.monotonic() + self.min_interval
+                try:
+                    observer.update(*args)
+                except Exception as e:
+                    print("Failed to update observer: {}: {}".format(observer, e))
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+class Notifier(metaclass=abc.ABCMeta):
+    """
+    Runs the update of a set of observers. A failing observer never stops the others from being
+    updated: notify returns the (observer, exception) pairs of the failed updates instead.
+    """
+
+    @abc.abstractmethod
+    def notify(self, observers, *args):
+        raise NotImplementedError("Abstract method")
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class SerialNotifier(Notifier):
+
+    def notify(self, observers, *args):
+        failures = []
+        for o in observers:
+            try:
+                o.update(*args)
+            except Exception as e:
+                failures.append((o, e))
+        return failures
+
+
+class PoolNotifier(Notifier):
+    """
+    Fans the updates out over a concurrent.futures pool, created on first use.
+    """
+    pool_class = None
+
+    def __init__(self, max_workers=None):
+        self.max_workers = max_workers
+        self.pool = None
+
+    def notify(self, observers, *args):
+        if self.pool is None:
+            self.pool = self.pool_class(max_workers=self.max_workers)
+        futures = [(o, self.pool.submit(o.update, *args)) for o in observers]
+        failures = []
+        for o, future in futures:
+            error = future.exception()
+            if error is not None:
+                failures.append((o, error))
+        return failures
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+
+class ThreadPoolNotifier(PoolNotifier):
+    """
+    For I/O bound observers.
+    """
+    pool_class = ThreadPoolExecutor
+
+
+class ProcessPoolNotifier(PoolNotifier):
+    """
+    For CPU bound observers. The observers are pickled into the worker processes, so they must be
+    picklable and any state they change there is not seen by the caller.
+    """
+    pool_class = ProcessPoolExecutor
+
+
+class AsyncioNotifier(Notifier):
+    """
+    Gathers the updates on an event loop. Observers with an `async def update` are awaited, plain
+    ones are run on the loop's default executor.
+    Called from outside of an event loop, notify runs one until the updates are done. Called from a
+    coroutine, it must not block the running loop: the updates are scheduled on it and notify returns
+    right away. Await drain() to wait for them and collect their failures.
+    """
+
+    def __init__(self):
+        self.pending = set()
+        self.failures = []
+
+    def notify(self, observers, *args):
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return asyncio.run(self.notify_async(observers, *args))
+        task = loop.create_task(self.notify_async(observers, *args))
+        self.pending.add(task)
+        task.add_done_callback(self._done)
+        return []
+
+    async def drain(self):
+        """
+        Wait for the scheduled updates, and return (and forget) the failures among them.
+        """
+        while self.pending:
+            await asyncio.gather(*self.pending, return_exceptions=True)
+        failures, self.failures = self.failures, []
+        return failures
+
+    def _done(self, task):
+        self.pending.discard(task)
+        if not task.cancelled() and task.exception() is None:
+            self.failures.extend(task.result())
+
+    async def notify_async(self, observers, *args):
+        loop = asyncio.get_running_loop()
+        observers = list(observers)
+        results = await asyncio.gather(*[
+            o.update(*args) if asyncio.iscoroutinefunction(o.update) else loop.run_in_executor(None, o.update, *args)
+            for o in observers
+        ], return_exceptions=True)
+        return [(o, result) for o, result in zip(observers, results) if isinstance(result, Exception)]
+
+
+class Weather(Observable):
+    FIELDS = ('temp', 'pressure', 'humidity')
+
+    def __init__(self, observers=None, scheduler=None, notifier=None):
         self.pressure = None
         self.temp = None
         self.humidity = None
-        self.observers = observers
+        # Observers of every update, and observers indexed by the field they subscribed to.
+        self.observers = ObserverRegistry(observers)
+        self.field_observers = {field: ObserverRegistry() for field in Weather.FIELDS}
+        self.registrations = itertools.count()
+        # When set, updates are handed to the scheduler instead of being delivered in place.
+        self.scheduler = scheduler
+        self.notifier = notifier or SerialNotifier()
 
-    def register_observer(self, observer):
-        if self.observers:
-            self.observers.append(observer)
-        else:
-            self.observers = [observer]
+    def register_observer(self, observer, fields=None, threshold=None):
+        fields = fields if fields is not None else observer.fields
+        if fields is None:
+            self.observers.add(observer)
+            return
+        unknown = set(fields) - set(Weather.FIELDS)
+        if unknown:
+            raise ValueError("Unknown weather fields: {}".format(", ".join(sorted(unknown))))
+        subscription = Subscription(next(self.registrations), fields, threshold if threshold is not None else observer.threshold)
+        for field in subscription.fields:
+            self.field_observers[field].add(observer, subscription)
 
     def remove_observer(self, observer):
-        try:
-            self.observers.remove(observer)
-        except ValueError:
+        registries = [self.observers] + list(self.field_observers.values())
+        registered = [registry for registry in registries if observer in registry]
+        if not registered:
             print("The given observer: {} is not registered.".format(observer))
+        for registry in registered:
+            registry.remove(observer)
 
-    def notify_observers(self):
-        for o in self.observers:
-            o.update(self.temp, self.pressure, self.humidity)
+    def notify_observers(self, changed=FIELDS):
+        observers = list(self.observers)
+        # Only the observers of the changed fields are looked at, each of them notified at most once
+        # and in the order they registered.
+        due = {}
+        for field in changed:
+            value = getattr(self, field)
+            for o, subscription in self.field_observers[field].items():
+                if id(o) not in due and subscription.is_due(field, value):
+                    due[id(o)] = (subscription.order, o, subscription)
+        for _, o, subscription in sorted(due.values(), key=lambda entry: entry[0]):
+            for field in subscription.fields:
+                subscription.last[field] = getattr(self, field)
+            observers.append(o)
+        self.deliver(observers)
+
+    def deliver(self, observers):
+        if self.scheduler is not None:
+            for o in observers:
+                self.scheduler.submit(o, self.temp, self.pressure, self.humidity)
+            return
+        for o, e in self.notifier.notify(observers, self.temp, self.pressure, self.humidity):
+            print("Failed to update observer: {}: {}".format(o, e))
 
     def update_weather(self, pressure, temp, humidity):
+        current = {'temp': temp, 'pressure': pressure, 'humidity': humidity}
+        changed = [field for field in Weather.FIELDS if getattr(self, field) != current[field]]
         self.temp = temp
         self.humidity = humidity
         self.pressure = pressure
-        self.notify_observers()
+        self.notify_observers(changed)
+
+
+class WeatherHub(Observable):
+    """
+    The weather of many cities. Instead of one Weather object per city, the readings are kept in
+    typed array columns indexed by city, next to a fixed-size ring buffer of past readings per city.
+    Observers are sharded by city, so an update only reaches the observers of that city.
+    Unknown readings are stored as NaN.
+    """
+
+    def __init__(self, history_size=16, notifier=None):
+        if history_size < 1:
+            raise ValueError("The history must keep at least one reading, got {}.".format(history_size))
+        self.history_size = history_size
+        self.index = {}
+        self.cities = []
+        self.columns = {field: array('d') for field in Weather.FIELDS}
+        # history[field][city * history_size + slot], heads[city] is the slot written next.
+        self.history = {field: array('d') for field in Weather.FIELDS}
+        self.heads = array('l')
+        self.sizes = array('l')
+        self.shards = {}
+        self.notifier = notifier or SerialNotifier()
+
+    def add_city(self, city):
+        if city not in self.index:
+            self.index[city] = len(self.cities)
+            self.cities.append(city)
+            for field in Weather.FIELDS:
+                self.columns[field].append(math.nan)
+                self.history[field].extend([math.nan] * self.history_size)
+            self.heads.append(0)
+            self.sizes.append(0)
+        return self.index[city]
+
+    def register_observer(self, observer, city):
+        self.shards.setdefault(self.add_city(city), ObserverRegistry()).add(observer)
+
+    def remove_observer(self, observer, city):
+        try:
+            self.shards[self.index[city]].remove(observer)
+        except (KeyError, ValueError):
+            print("The given observer: {} is not registered for {}.".format(observer, city))
+
+    def notify_observers(self, cities=None):
+        indexes = list(self.shards) if cities is None else dict.fromkeys(self.index[city] for city in cities)
+        for i in indexes:
+            shard = self.shards.get(i)
+            if shard:
+                args = (self.columns['temp'][i], self.columns['pressure'][i], self.columns['humidity'][i])
+                for o, e in self.notifier.notify(shard, *args):
+                    print("Failed to update observer: {}: {}".format(o, e))
+
+    def update_weather(self, city, pressure, temp, humidity):
+        self.bulk_update([city], [pressure], [temp], [humidity])
+
+    def bulk_update(self, cities, pressures, temps, humidities):
+        """
+        Update many cities in one call: the columns and history are written in a single pass and the
+        observers notified afterwards, once per updated city.
+        """
+        temp, pressure, humidity = self.columns['temp'], self.columns['pressure'], self.columns['humidity']
+        temp_history, pressure_history, humidity_history = (
+            self.history['temp'], self.history['pressure'], self.history['humidity'])
+        size = self.history_size
+        indexes = [self.add_city(city) for city in cities]
+        for i, p, t, h in zip(indexes, pressures, temps, humidities):
+            temp[i], pressure[i], humidity[i] = t, p, h
+            slot = i * size + self.heads[i]
+            temp_history[slot], pressure_history[slot], humidity_history[slot] = t, p, h
+            self.heads[i] = (self.heads[i] + 1) % size
+            if self.sizes[i] < size:
+                self.sizes[i] += 1
+        if self.shards:
+            self.notify_observers(cities)
+
+    def get_weather(self, city):
+        i = self.index[city]
+        return self.columns['temp'][i], self.columns['pressure'][i], self.columns['humidity'][i]
+
+    def get_history(self, city):
+        """
+        The past readings of the city as (temp, pressure, humidity) tuples, oldest first.
+        """
+        i = self.index[city]
+        start = i * self.history_size
+        slots = [start + (self.heads[i] - self.sizes[i] + n) % self.history_size for n in range(self.sizes[i])]
+        return [tuple(self.history[field][slot] for field in Weather.FIELDS) for slot in slots]
+
+    def nbytes(self):
+        arrays = list(self.columns.values()) + list(self.history.values()) + [self.heads, self.sizes]
+        return sum(a.itemsize * len(a) for a in arrays)
 
 
 class MobileDisplay(Observer, Display):
+    fields = ('pressure',)
 
     def __init__(self, weather_object=None):
-        # Only updates pressure. Pull pattern will work better here.
+        # Only updates pressure, so it subscribes to pressure changes alone.
         self.pressure = None
         self.weather_object = weather_object
         self.weather_object.register_observer(self)
@@ -91,9 +506,11 @@ class MobileDisplay(Observer, Display):
 
 
 class WatchDisplay(Observer, Display):
+    fields = ('temp',)
+    threshold = 0.5
 
     def __init__(self, weather_object=None):
-        # Only updates pressure. Pull pattern will work better here.
+        # Only updates temperature, and ignores changes within half a degree.
         self.temp = None
         self.weather_object = weather_object
         self.weather_object.register_observer(self)
@@ -106,8 +523,101 @@ class WatchDisplay(Observer, Display):
         print("Watch display: The temperature is {}".format(self.temp))
 
 
+class CityDisplay(Observer, Display):
+
+    def __init__(self, hub, city):
+        self.temp = None
+        self.city = city
+        hub.register_observer(self, city)
+
+    def update(self, temp, pressure, humidity):
+        self.temp = temp
+        self.display()
+
+    def display(self):
+        print("{} display: The temperature is {}".format(self.city, self.temp))
+
+
+class _BenchmarkObserver(Observer):
+
+    def update(self, temp, pressure, humidity):
+        pass
+
+
+def benchmark_registry(count=100000):
+    weather = Weather()
+    observers = [_BenchmarkObserver() for _ in range(count)]
+    register = timeit.timeit(lambda: [weather.register_observer(o) for o in observers], number=1)
+    notify = timeit.timeit(lambda: weather.update_weather(1012, 28, 60), number=1)
+    remove = timeit.timeit(lambda: [weather.remove_observer(o) for o in observers], number=1)
+    print("{} observers: register {:.3f}s, notify {:.3f}s, remove {:.3f}s".format(count, register, notify, remove))
+    weather.register_observer(observers[0])
+    del observers
+    print("Observers left after the displays were collected: {}".format(len(weather.observers)))
+
+
+class _CpuBoundObserver(Observer):
+
+    def update(self, temp, pressure, humidity):
+        sum(i * i for i in range(50000))
+
+
+class _IoBoundObserver(Observer):
+
+    def update(self, temp, pressure, humidity):
+        time.sleep(0.01)
+
+
+def benchmark_notifiers(count=64, workers=(1, 2, 4, 8)):
+    for observer_class in (_CpuBoundObserver, _IoBoundObserver):
+        observers = [observer_class() for _ in range(count)]
+        serial = timeit.timeit(lambda: SerialNotifier().notify(observers, 28, 1012, 60), number=1)
+        print("{} x {}: serial {:.0f} updates/s".format(count, observer_class.__name__, count / serial))
+        for notifier_class in (ThreadPoolNotifier, ProcessPoolNotifier):
+            for max_workers in workers:
+                with notifier_class(max_workers) as notifier:
+                    # Warm up the pool so that starting the workers is not measured.
+                    notifier.notify(observers[:max_workers], 28, 1012, 60)
+                    elapsed = timeit.timeit(lambda: notifier.notify(observers, 28, 1012, 60), number=1)
+                print("    {} with {} workers: {:.0f} updates/s".format(notifier_class.__name__, max_workers, count / elapsed))
+
+
 if __name__ == '__main__':
     weather = Weather()
     mobile = MobileDisplay(weather)
     watch = WatchDisplay(weather)
     weather.update_weather(1012, 28, 60)
+    weather.update_weather(1012, 28.2, 65)
+    weather.update_weather(1009, 29, 65)
+    print("--- Scheduled: 100 readings, at most 4 updates a second per display ---")
+    with NotificationScheduler(max_rate=4) as scheduler:
+        weather.scheduler = scheduler
+        for i in range(100):
+            weather.update_weather(1000 + i, 20 + i, 60)
+            time.sleep(0.005)
+    weather.scheduler = None
+    print("--- Thread pool ---")
+    with ThreadPoolNotifier(max_workers=4) as notifier:
+        weather.notifier = notifier
+        weather.update_weather(1020, 30, 60)
+    weather.notifier = SerialNotifier()
+    print("--- Asyncio, from a coroutine ---")
+
+    async def report_weather():
+        weather.notifier = AsyncioNotifier()
+        weather.update_weather(1021, 31, 60)
+        for o, e in await weather.notifier.drain():
+            print("Failed to update observer: {}: {}".format(o, e))
+
+    asyncio.run(report_weather())
+    weather.notifier = SerialNotifier()
+    print("--- Weather hub ---")
+    hub = WeatherHub(history_size=4)
+    bangalore = CityDisplay(hub, "Bangalore")
+    cities = ["City {}".format(i) for i in range(10000)] + ["Bangalore"]
+    for reading in range(6):
+        hub.bulk_update(cities, [1000 + reading] * len(cities), [20 + reading] * len(cities), [60] * len(cities))
+    print("History of Bangalore: {}".format(hub.get_history("Bangalore")))
+    print("{} cities in {} bytes, {:.0f} bytes per city".format(len(hub.cities), hub.nbytes(), hub.nbytes() / len(hub.cities)))
+    benchmark_registry()
+    benchmark_notifiers()
@@ -5,6 +5,10 @@ Helps in solving "Open-Closed Principle" in SOLID
 """
 
 import abc
+import math
+import random
+import time
+from collections import OrderedDict, namedtuple
 
 """
 Use case: 
@@ -74,6 +78,260 @@ class AutoStrategy(TravelStrategy):
         raise NotImplementedError
 
 
+Trip = namedtuple('Trip', ['distance', 'budget', 'hourly_value'])
+Trip.__doc__ = """
+The inputs a travel decision depends on: distance in km, the most the person wants to spend (None
+for no limit) and what an hour of their time is worth.
+"""
+
+
+def fare_cost(fixed, per_km, kmph, max_distance=None):
+    """
+    Build a cost function scoring a trip by its fare plus the value of the time spent travelling.
+    Trips over the budget or the max distance cost infinity, i.e. the strategy is not an option.
+    """
+
+    def cost(trip):
+        fare = fixed + per_km * trip.distance
+        if (trip.budget is not None and fare > trip.budget) or (max_distance is not None and trip.distance > max_distance):
+            return math.inf
+        return fare + trip.hourly_value * trip.distance / kmph
+
+    return cost
+
+
+class LRUCache(object):
+    """
+    Least recently used cache whose entries optionally expire ttl seconds after they were set.
+    """
+
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+
+    def get(self, key, default=None):
+        entry = self.entries.get(key)
+        if entry is None:
+            return default
+        value, expires = entry
+        if expires is not None and expires <= time.monotonic():
+            del self.entries[key]
+            return default
+        self.entries.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        self.entries[key] = (value, time.monotonic() + self.ttl if self.ttl is not None else None)
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class StrategySelector(object):
+    """
+    Picks the cheapest registered TravelStrategy for a trip according to each strategy's cost function.
+    Rankings are memoized per trip, and a strategy that fails makes way for the next best one.
+    """
+
+    def __init__(self, cache_size=1024, ttl=None):
+        self.costs = OrderedDict()
+        self.cache = LRUCache(cache_size, ttl)
+
+    def register(self, strategy, cost):
+        self.costs[strategy] = cost
+        self.cache.clear()
+
+    def rank(self, trip):
+        """
+        The feasible strategies for the trip, cheapest first.
+        """
+        ranking = self.cache.get(trip)
+        if ranking is None:
+            scores = sorted((cost(trip), i, strategy) for i, (strategy, cost) in enumerate(self.costs.items()))
+            ranking = tuple(strategy for score, _, strategy in scores if score != math.inf)
+            self.cache.set(trip, ranking)
+        return ranking
+
+    def select(self, trip):
+        ranking = self.rank(trip)
+        if not ranking:
+            raise ValueError("No travel strategy fits the trip: {}".format(trip))
+        return ranking[0]
+
+    def select_many(self, trips):
+        """
+        Select a strategy for every trip of a batch. Each distinct trip is scored once for the whole
+        batch, so the cost of a large batch depends on how many different trips it contains.
+        A trip no strategy fits gets None instead of failing the whole batch.
+        """
+        choices = {}
+        selected = []
+        for trip in trips:
+            if trip in choices:
+                choice = choices[trip]
+            else:
+                ranking = self.rank(trip)
+                choice = choices[trip] = ranking[0] if ranking else None
+            selected.append(choice)
+        return selected
+
+    def travel(self, trip):
+        for strategy in self.rank(trip):
+            try:
+                return strategy.travel()
+            except Exception as e:
+                print("{} failed ({!r}), falling back to the next strategy.".format(strategy.__class__.__name__, e))
+        raise ValueError("No travel strategy could make the trip: {}".format(trip))
+
+
+class SelectedStrategy(TravelStrategy):
+    """
+    Lets a Person travel with whatever the selector picks for their trip.
+    """
+
+    def __init__(self, selector, trip):
+        self.selector = selector
+        self.trip = trip
+
+    def travel(self):
+        return self.selector.travel(self.trip)
+
+
+class InstrumentedStrategy(TravelStrategy):
+    """
+    Wraps a TravelStrategy and records how long its travel() takes and how often it fails.
+    """
+
+    def __init__(self, strategy):
+        self.strategy = strategy
+        self.name = getattr(strategy, 'name', strategy.__class__.__name__)
+        self.calls = 0
+        self.failures = 0
+        self.total_latency = 0.0
+
+    def travel(self):
+        start = time.perf_counter()
+        try:
+            return self.strategy.travel()
+        except Exception:
+            self.failures += 1
+            raise
+        finally:
+            self.calls += 1
+            self.total_latency += time.perf_counter() - start
+
+    @property
+    def mean_latency(self):
+        return self.total_latency / self.calls if self.calls else 0.0
+
+    @property
+    def failure_rate(self):
+        return self.failures / self.calls if self.calls else 0.0
+
+    def metrics(self):
+        return {
+            'calls': self.calls,
+            'failures': self.failures,
+            'failure_rate': self.failure_rate,
+            'mean_latency': self.mean_latency,
+        }
+
+
+class BanditStrategy(TravelStrategy):
+    """
+    Epsilon-greedy choice between instrumented strategies: mostly the healthy strategy with the lowest
+    mean latency, now and then a random one to keep the measurements of the others fresh.
+    A strategy is unhealthy once its failure rate is above max_failure_rate. A failed trip is retried
+    with the next fastest strategy.
+    """
+
+    def __init__(self, strategies, epsilon=0.1, max_failure_rate=0.5, rng=None):
+        self.strategies = [InstrumentedStrategy(strategy) for strategy in strategies]
+        self.epsilon = epsilon
+        self.max_failure_rate = max_failure_rate
+        self.rng = rng or random.Random()
+
+    def ranking(self):
+        untried = [s for s in self.strategies if not s.calls]
+        healthy = sorted(
+            (s for s in self.strategies if s.calls and s.failure_rate <= self.max_failure_rate),
+            key=lambda s: s.mean_latency)
+        unhealthy = [s for s in self.strategies if s.calls and s.failure_rate > self.max_failure_rate]
+        ranking = untried + healthy + unhealthy
+        if self.rng.random() < self.epsilon:
+            ranking.insert(0, ranking.pop(self.rng.randrange(len(ranking))))
+        return ranking
+
+    def travel(self):
+        for strategy in self.ranking():
+            try:
+                return strategy.travel()
+            except Exception:
+                continue
+        raise ValueError("Every travel strategy failed.")
+
+    def metrics(self):
+        return {s.name: s.metrics() for s in self.strategies}
+
+
+class _SimulatedStrategy(TravelStrategy):
+
+    def __init__(self, name, latency, failure_rate=0.0, rng=None):
+        self.name = name
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.rng = rng or random.Random(0)
+
+    def travel(self):
+        time.sleep(self.latency)
+        if self.rng.random() < self.failure_rate:
+            raise RuntimeError("{} is unavailable".format(self.name))
+
+
+def benchmark_bandit(trips=500):
+    bandit = BanditStrategy([
+        _SimulatedStrategy('Bus', latency=0.002),
+        _SimulatedStrategy('Slow', latency=0.004),
+        _SimulatedStrategy('Fast', latency=0.001),
+        _SimulatedStrategy('Fast but flaky', latency=0.0005, failure_rate=0.7),
+    ], rng=random.Random(0))
+    person = Person('Simulated', bandit)
+    for _ in range(trips):
+        person.travel_to_airport()
+    for name, metrics in bandit.metrics().items():
+        print("{:>15}: {}".format(name, {k: round(v, 4) for k, v in metrics.items()}))
+
+
+def default_selector(cache_size=1024, ttl=None):
+    selector = StrategySelector(cache_size, ttl)
+    selector.register(BusStrategy(), fare_cost(fixed=0, per_km=2, kmph=15))
+    selector.register(CabStrategy(), fare_cost(fixed=50, per_km=20, kmph=30))
+    selector.register(WalkStrategy(), fare_cost(fixed=0, per_km=0, kmph=5, max_distance=3))
+    selector.register(AutoStrategy(), fare_cost(fixed=25, per_km=12, kmph=30))
+    return selector
+
+
+def benchmark_selector(count=1000000):
+    random.seed(0)
+    trips = [
+        Trip(random.randint(1, 50), random.choice([None, 200, 500]), random.choice([50, 200, 600]))
+        for _ in range(count)
+    ]
+    selector = default_selector()
+    start = time.perf_counter()
+    selected = selector.select_many(trips)
+    elapsed = time.perf_counter() - start
+    print("Planned {} trips ({} distinct, {} infeasible) in {:.2f}s".format(
+        count, len(set(trips)), selected.count(None), elapsed))
+
+
 if __name__ == '__main__':
     walk = WalkStrategy()
     bus = BusStrategy()
@@ -82,4 +340,14 @@ if __name__ == '__main__':
     person = Person('Saurav', bus)
     person.travel_to_airport()
     person_fresher = Person('Fresher', auto)
-    person_fresher.travel_to_airport()
+    try:
+        person_fresher.travel_to_airport()
+    except NotImplementedError:
+        print("{} could not get an auto.".format(person_fresher.name))
+    selector = default_selector()
+    person_in_hurry = Person('Hurried', SelectedStrategy(selector, Trip(distance=5, budget=None, hourly_value=600)))
+    person_in_hurry.travel_to_airport()
+    person_nearby = Person('Nearby', SelectedStrategy(selector, Trip(distance=2, budget=0, hourly_value=50)))
+    person_nearby.travel_to_airport()
+    benchmark_selector()
+    benchmark_bandit()
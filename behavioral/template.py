@@ -7,6 +7,12 @@ Based on Inversion of Control aka Hollywood's Principle
 """
 
 import abc
+import functools
+import queue
+import threading
+import time
+import timeit
+from collections import OrderedDict
 
 """
 Use case: 
@@ -14,17 +20,57 @@ KFC plans to open some restaurants in India. Most of the people in India are veg
 """
 
 
+def pure_step(maxsize=128):
+    """
+    Declare a template step as pure: its result depends on its arguments only, never on the burger.
+    The result is then computed once and shared by every instance of every subclass that does not
+    override the step, in a bounded cache evicting the least recently used entries.
+    """
+
+    def decorator(step):
+        cache = OrderedDict()
+        lock = threading.Lock()
+
+        @functools.wraps(step)
+        def wrapper(self, *args):
+            with lock:
+                if args in cache:
+                    cache.move_to_end(args)
+                    return cache[args]
+            result = step(self, *args)
+            with lock:
+                cache[args] = result
+                if len(cache) > maxsize:
+                    cache.popitem(last=False)
+            return result
+
+        wrapper.pure = True
+        wrapper.cache = cache
+        return wrapper
+
+    return decorator
+
+
 class Burger(metaclass=abc.ABCMeta):
+    # The steps of the template, in the order make_burger runs them.
+    steps = ('make_buns', 'insert_patty', 'insert_toppings')
+
     def make_burger(self):
-        self.make_buns()
-        self.insert_patty()
-        self.insert_toppings()
+        for step in self.steps:
+            self.run_step(step)
 
+    def run_step(self, step):
+        result = getattr(self, step)()
+        if result is not None:
+            print(result)
+
+    @pure_step()
     def make_buns(self):
-        print("Buns have been baked.")
+        return "Buns have been baked."
 
+    @pure_step()
     def insert_toppings(self):
-        print("Tomato and onions have been inserted")
+        return "Tomato and onions have been inserted"
 
     @abc.abstractmethod
     def insert_patty(self):
@@ -33,12 +79,185 @@ class Burger(metaclass=abc.ABCMeta):
 
 class VegBurger(Burger):
     def insert_patty(self):
-        print("A veg patty has been inserted")
+        return "A veg patty has been inserted"
 
 
 class NonVegBurger(Burger):
     def insert_patty(self):
-        print("A non-veg patty has been inserted")
+        return "A non-veg patty has been inserted"
+
+
+class Stage(object):
+    """
+    One step of the assembly line: a pool of workers taking burgers from a bounded input queue.
+    A burger whose step raises is taken off the line, with the error kept in `errors`.
+    """
+    _done = object()
+
+    def __init__(self, step, workers=1, queue_size=16):
+        self.step = step
+        self.workers = workers
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.lock = threading.Lock()
+        self.threads = []
+        self.reset()
+
+    def reset(self):
+        self.processed = 0
+        self.busy_time = 0.0
+        self.max_depth = 0
+        self.errors = []
+
+    def put(self, burger):
+        # Blocks while the stage is backed up, which slows down the stage feeding it.
+        self.queue.put(burger)
+        depth = self.queue.qsize()
+        if depth > self.max_depth:
+            self.max_depth = depth
+
+    def start(self, downstream):
+        self.threads = [threading.Thread(target=self._work, args=(downstream,), daemon=True) for _ in range(self.workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self):
+        for _ in self.threads:
+            self.queue.put(Stage._done)
+        for thread in self.threads:
+            thread.join()
+
+    def _work(self, downstream):
+        while True:
+            burger = self.queue.get()
+            if burger is Stage._done:
+                return
+            start = time.perf_counter()
+            try:
+                burger.run_step(self.step)
+            except Exception as e:
+                error = e
+            else:
+                error = None
+            with self.lock:
+                self.processed += 1
+                self.busy_time += time.perf_counter() - start
+                if error is not None:
+                    self.errors.append((burger, error))
+            if error is None:
+                downstream(burger)
+
+
+class AssemblyLine(object):
+    """
+    Runs the template steps of many burgers as a pipeline: every step is a stage with its own workers,
+    so the buns of the next order bake while the patty goes into the current one.
+    Works for any Burger subclass, the stages only call the steps listed in Burger.steps.
+    """
+
+    def __init__(self, workers=None, queue_size=16, steps=Burger.steps):
+        workers = workers or {}
+        self.stages = [Stage(step, workers.get(step, 1), queue_size) for step in steps]
+        self.elapsed = 0.0
+
+    def run(self, burgers):
+        """
+        Make all the burgers and return them in the order they were finished. The burgers that failed a
+        step are left out; see failed().
+        """
+        for stage in self.stages:
+            stage.reset()
+        finished = []
+        lock = threading.Lock()
+
+        def collect(burger):
+            with lock:
+                finished.append(burger)
+
+        for stage, downstream in zip(self.stages, self.stages[1:]):
+            stage.start(downstream.put)
+        self.stages[-1].start(collect)
+        start = time.perf_counter()
+        for burger in burgers:
+            self.stages[0].put(burger)
+        # Stopping the stages front to back drains each one before the next is told to finish.
+        for stage in self.stages:
+            stage.stop()
+        self.elapsed = time.perf_counter() - start
+        return finished
+
+    def failed(self):
+        """
+        (burger, step, error) for every burger of the last run that failed a step.
+        """
+        return [(burger, stage.step, error) for stage in self.stages for burger, error in stage.errors]
+
+    def report(self):
+        return {
+            stage.step: {
+                'workers': stage.workers,
+                'processed': stage.processed,
+                'throughput': stage.processed / self.elapsed if self.elapsed else 0.0,
+                'utilization': stage.busy_time / (stage.workers * self.elapsed) if self.elapsed else 0.0,
+                'max_queue_depth': stage.max_depth,
+                'failed': len(stage.errors),
+            }
+            for stage in self.stages
+        }
+
+
+class _BurntPattyBurger(Burger):
+
+    def insert_patty(self):
+        raise ValueError("The patty is burnt")
+
+
+class _TimedBurger(Burger):
+
+    def make_buns(self):
+        time.sleep(0.003)
+
+    def insert_patty(self):
+        time.sleep(0.002)
+
+    def insert_toppings(self):
+        time.sleep(0.001)
+
+
+class _SlowSharedStepsBurger(Burger):
+
+    def make_buns(self):
+        time.sleep(0.003)
+        return "Buns have been baked."
+
+    def insert_toppings(self):
+        time.sleep(0.001)
+        return "Tomato and onions have been inserted"
+
+    def insert_patty(self):
+        time.sleep(0.002)
+
+
+class _CachedSharedStepsBurger(_SlowSharedStepsBurger):
+    make_buns = pure_step()(_SlowSharedStepsBurger.make_buns)
+    insert_toppings = pure_step()(_SlowSharedStepsBurger.insert_toppings)
+
+
+def benchmark_pure_steps(orders=200):
+    for burger_class in (_SlowSharedStepsBurger, _CachedSharedStepsBurger):
+        burgers = [burger_class() for _ in range(orders)]
+        elapsed = timeit.timeit(lambda: [[getattr(b, step)() for step in b.steps] for b in burgers], number=1)
+        print("{}: {:.2f} ms per burger".format(burger_class.__name__, elapsed / orders * 1000))
+
+
+def benchmark_assembly_line(orders=300):
+    serial = timeit.timeit(lambda: [_TimedBurger().make_burger() for _ in range(orders)], number=1)
+    print("Serial template: {:.0f} burgers/s".format(orders / serial))
+    for workers in ({}, {'make_buns': 3, 'insert_patty': 2}):
+        line = AssemblyLine(workers)
+        line.run(_TimedBurger() for _ in range(orders))
+        print("Assembly line {}: {:.0f} burgers/s".format(workers or "with one worker per stage", orders / line.elapsed))
+        for step, stats in line.report().items():
+            print("    {:>15}: {}".format(step, {k: round(v, 2) for k, v in stats.items()}))
 
 
 if __name__ == '__main__':
@@ -46,3 +265,10 @@ if __name__ == '__main__':
     veg_burger.make_burger()
     non_ver_burger = NonVegBurger()
     non_ver_burger.make_burger()
+    print("--- Assembly line ---")
+    line = AssemblyLine()
+    line.run([VegBurger(), NonVegBurger(), _BurntPattyBurger(), VegBurger()])
+    for burger, step, error in line.failed():
+        print("{} failed to {}: {}".format(burger.__class__.__name__, step, error))
+    benchmark_assembly_line()
+    benchmark_pure_steps()
@@ -3,8 +3,13 @@
 """
 
 import abc
+import copy
+import gc
+import threading
+import time
+import tracemalloc
 
-from creational.factory_method import PizzaStore
+from creational.factory_method import PizzaRegistry, PizzaStore, UnknownPizzaError
 
 """
 Use case:
@@ -12,31 +17,97 @@ Pizza Factory with customization of ingredients
 """
 
 
-class ThinCrustDough:
-    pass
+class Ingredient(object):
+    __slots__ = ()
 
 
-class ThickCrustDough:
-    pass
+class SharedIngredient(Ingredient):
+    """
+    Flyweight for ingredients without state: every class has a single interned instance.
+    """
+    __slots__ = ()
+    _instances = {}
 
+    def __new__(cls):
+        instance = SharedIngredient._instances.get(cls)
+        if instance is None:
+            instance = SharedIngredient._instances[cls] = super().__new__(cls)
+        return instance
 
-class HotSauce:
-    pass
 
+class PooledIngredient(Ingredient):
+    """
+    Ingredient with state of its own. Instances are recycled through an IngredientPool.
+    """
+    __slots__ = ('kneaded',)
 
-class TomatoSauce:
-    pass
+    def __init__(self):
+        self.reset()
 
+    def reset(self):
+        self.kneaded = False
 
-class MozzarellaCheese:
-    pass
 
+class IngredientPool(object):
+    """
+    Bounded free lists of pooled ingredients, one per class.
+    """
+
+    def __init__(self, maxsize=64):
+        self.maxsize = maxsize
+        self.free = {}
+        self.lock = threading.Lock()
+
+    def acquire(self, ingredient_class):
+        with self.lock:
+            free = self.free.get(ingredient_class)
+            if free:
+                return free.pop()
+        return ingredient_class()
+
+    def release(self, ingredient):
+        if not isinstance(ingredient, PooledIngredient):
+            return
+        ingredient.reset()
+        with self.lock:
+            free = self.free.setdefault(type(ingredient), [])
+            if len(free) < self.maxsize:
+                free.append(ingredient)
+
+
+class ThinCrustDough(PooledIngredient):
+    __slots__ = ()
+
+
+class ThickCrustDough(PooledIngredient):
+    __slots__ = ()
+
+
+class HotSauce(SharedIngredient):
+    __slots__ = ()
+
+
+class TomatoSauce(SharedIngredient):
+    __slots__ = ()
 
-class ReggianoCheese:
-    pass
+
+class MozzarellaCheese(SharedIngredient):
+    __slots__ = ()
+
+
+class ReggianoCheese(SharedIngredient):
+    __slots__ = ()
 
 
 class PizzaIngredientFactory(metaclass=abc.ABCMeta):
+    pool = IngredientPool()
+
+    def release(self, *ingredients):
+        """
+        Hand the ingredients back once the pizza is done with them.
+        """
+        for ingredient in ingredients:
+            self.pool.release(ingredient)
 
     @abc.abstractmethod
     def create_dough(self):
@@ -54,7 +125,7 @@ class PizzaIngredientFactory(metaclass=abc.ABCMeta):
 class NYPizzaIngredientFactory(PizzaIngredientFactory):
 
     def create_dough(self):
-        return ThickCrustDough()
+        return self.pool.acquire(ThickCrustDough)
 
     def create_sauce(self):
         return HotSauce()
@@ -66,7 +137,7 @@ class NYPizzaIngredientFactory(PizzaIngredientFactory):
 class CAPizzaIngredientFactory(PizzaIngredientFactory):
 
     def create_dough(self):
-        return ThinCrustDough()
+        return self.pool.acquire(ThinCrustDough)
 
     def create_sauce(self):
         return TomatoSauce()
@@ -81,14 +152,17 @@ class Pizza(metaclass=abc.ABCMeta):
     def prepare(self):
         pass
 
+    def clone(self):
+        return copy.copy(self)
+
     def bake(self):
-        print('Baking for 30 mins at 225 F')
+        return 'Baking for 30 mins at 225 F'
 
     def cut(self):
-        print("Cutting into 6 equal slices")
+        return "Cutting into 6 equal slices"
 
     def pack(self):
-        print("Packing into corrugated boxes")
+        return "Packing into corrugated boxes"
 
 
 class CheesePizza(Pizza):
@@ -99,23 +173,73 @@ class CheesePizza(Pizza):
         dough = self.ingredient_factory.create_dough()
         sauce = self.ingredient_factory.create_sauce()
         cheese = self.ingredient_factory.create_cheese()
-        print(
-            'Prepared pizza using: dough: {}, sauce: {}, cheese: {}'.format(
-                dough.__class__.__name__, sauce.__class__.__name__, cheese.__class__.__name__
-            )
+        self.ingredient_factory.release(dough, sauce, cheese)
+        return 'Prepared pizza using: dough: {}, sauce: {}, cheese: {}'.format(
+            dough.__class__.__name__, sauce.__class__.__name__, cheese.__class__.__name__
         )
 
 
 class NewYorkPizzaStore(PizzaStore):
+    pizzas = PizzaRegistry("New York", {'cheese': CheesePizza})
+
     def create_pizza(self, type):
-        if type == 'cheese':
-            return CheesePizza(NYPizzaIngredientFactory())
+        return self.pizzas.create(type, NYPizzaIngredientFactory())
 
 
 class CaliforniaPizzaStore(PizzaStore):
+    pizzas = PizzaRegistry("California", {'cheese': CheesePizza})
+
     def create_pizza(self, type):
-        if type == 'cheese':
-            return CheesePizza(CAPizzaIngredientFactory())
+        return self.pizzas.create(type, CAPizzaIngredientFactory())
+
+
+class _PlainDough:
+    def __init__(self):
+        self.kneaded = False
+
+
+class _PlainSauce:
+    pass
+
+
+class _PlainCheese:
+    pass
+
+
+def benchmark_ingredients(pizzas=100000, in_flight=1000):
+    """
+    Prepare pizzas with plain, freshly allocated ingredients and with the pooled/flyweight ones,
+    keeping in_flight pizzas' ingredients alive at a time.
+    """
+
+    def plain():
+        batch = []
+        for _ in range(pizzas):
+            batch.append((_PlainDough(), _PlainSauce(), _PlainCheese()))
+            if len(batch) == in_flight:
+                batch = []
+
+    def pooled():
+        factory = NYPizzaIngredientFactory()
+        factory.pool = IngredientPool(maxsize=in_flight)
+        batch = []
+        for _ in range(pizzas):
+            batch.append((factory.create_dough(), factory.create_sauce(), factory.create_cheese()))
+            if len(batch) == in_flight:
+                for ingredients in batch:
+                    factory.release(*ingredients)
+                batch = []
+
+    for name, prepare in (('plain', plain), ('pooled', pooled)):
+        collections = sum(stats['collections'] for stats in gc.get_stats())
+        tracemalloc.start()
+        start = time.perf_counter()
+        prepare()
+        elapsed = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        collections = sum(stats['collections'] for stats in gc.get_stats()) - collections
+        print("{:>6}: {:.2f}s, peak {} KiB, {} gc collections".format(name, elapsed, peak // 1024, collections))
 
 
 if __name__ == '__main__':
@@ -123,3 +247,10 @@ if __name__ == '__main__':
     ny_store.order_pizza('cheese')
     ca_store = CaliforniaPizzaStore()
     ca_store.order_pizza('cheese')
+    try:
+        ca_store.order_pizza('pineapple')
+    except UnknownPizzaError as e:
+        print(e)
+    for result in ny_store.order_many(['cheese'] * 3, ovens=2):
+        print(result.steps)
+    benchmark_ingredients()
@@ -3,6 +3,21 @@ Encapsulates the request as an object, thus enables performing different acction
 """
 
 import abc
+import bisect
+import contextlib
+import io
+import mmap
+import os
+import queue
+import random
+import struct
+import tempfile
+import threading
+import time
+import timeit
+import tracemalloc
+from array import array
+from concurrent.futures import ThreadPoolExecutor
 
 """
 Use case:
@@ -13,23 +28,29 @@ A Home automation system has a remote with several slots to manage multiple appl
 class Light:
     def __init__(self, name):
         self.name = name
+        self.on = False
 
     def turn_off(self):
         print("Turning off the {} light".format(self.name))
+        self.on = False
 
     def turn_on(self):
         print("Turning on the {} light".format(self.name))
+        self.on = True
 
 
 class MusicPlayer:
     def __init__(self, name):
         self.name = name
+        self.on = False
 
     def turn_off(self):
         print("Turning off the {} music player".format(self.name))
+        self.on = False
 
     def turn_on(self):
         print("Turning on the {} music player".format(self.name))
+        self.on = True
 
 
 class CeilingFan:
@@ -60,6 +81,8 @@ class CeilingFan:
 
 
 class Command(metaclass=abc.ABCMeta):
+    # The device the command acts on. None for commands acting on several devices, e.g. macros.
+    device = None
 
     @abc.abstractmethod
     def execute(self):
@@ -69,10 +92,23 @@ class Command(metaclass=abc.ABCMeta):
     def undo(self):
         raise NotImplementedError
 
+    def undo_state(self):
+        """
+        What undoing the command needs to know, captured right before the command is executed.
+        """
+        return None
+
+    def undo_to(self, state):
+        """
+        Undo the command given the state captured by undo_state.
+        """
+        self.undo()
+
 
 class MusicOnCommand(Command):
     def __init__(self, player):
         self.player = player
+        self.device = player
 
     def execute(self):
         self.player.turn_on()
@@ -84,6 +120,7 @@ class MusicOnCommand(Command):
 class MusicOffCommand(Command):
     def __init__(self, player):
         self.player = player
+        self.device = player
 
     def execute(self):
         self.player.turn_off()
@@ -96,19 +133,26 @@ class CeilingFanBaseCommand(Command):
 
     def __init__(self, fan):
         self.fan = fan
+        self.device = fan
         self.previous_speed = None
 
     def execute(self):
         raise NotImplementedError
 
     def undo(self):
-        if self.previous_speed == CeilingFan.HIGH:
+        self.undo_to(self.previous_speed)
+
+    def undo_state(self):
+        return self.fan.speed
+
+    def undo_to(self, previous_speed):
+        if previous_speed == CeilingFan.HIGH:
             self.fan.high()
-        elif self.previous_speed == CeilingFan.MEDIUM:
+        elif previous_speed == CeilingFan.MEDIUM:
             self.fan.medium()
-        elif self.previous_speed == CeilingFan.LOW:
+        elif previous_speed == CeilingFan.LOW:
             self.fan.low()
-        elif self.previous_speed == CeilingFan.OFF:
+        elif previous_speed == CeilingFan.OFF:
             self.fan.off()
 
 
@@ -144,6 +188,7 @@ class LightsOnCommand(Command):
 
     def __init__(self, light):
         self.light = light
+        self.device = light
 
     def execute(self):
         self.light.turn_on()
@@ -156,6 +201,7 @@ class LightsOffCommand(Command):
 
     def __init__(self, light):
         self.light = light
+        self.device = light
 
     def execute(self):
         self.light.turn_off()
@@ -164,53 +210,934 @@ class LightsOffCommand(Command):
         self.light.turn_on()
 
 
-class PartyOnMacroCommand(Command):
-    def __init__(self, commands):
-        self.commands = commands
+def describe_errors(errors):
+    return "; ".join("{}: {}".format(command.__class__.__name__, error) for command, error in errors)
 
-    def execute(self):
-        for command in self.commands:
-            command.execute()
 
-    def undo(self):
-        for command in self.commands:
-            command.undo()
+class RollbackError(RuntimeError):
+    """
+    Steps of a macro that could not be undone. Every other step has been undone.
+    """
+
+    def __init__(self, errors):
+        super().__init__("{} step(s) could not be undone: {}".format(len(errors), describe_errors(errors)))
+        self.errors = errors
+
 
+class MacroFailedError(RuntimeError):
+    def __init__(self, command, error, rollback_errors=()):
+        message = "{} failed, the macro has been rolled back: {}".format(command.__class__.__name__, error)
+        if rollback_errors:
+            message += " (and could not undo {})".format(describe_errors(rollback_errors))
+        super().__init__(message)
+        self.command = command
+        self.error = error
+        self.rollback_errors = list(rollback_errors)
 
-class PartyOffMacroCommand(Command):
-    def __init__(self, commands):
+
+class MacroCommand(Command):
+    """
+    Runs its commands as one transaction. The commands of different devices run at the same time on up to
+    `workers` threads (one per device by default, at most max_workers), the commands of the same device in
+    the order given.
+    When a command fails, the commands that have not started yet are skipped, the completed ones are undone
+    in the reverse order they completed in, and MacroFailedError is raised. Undo goes in reverse order too.
+    The undo state of an execution is the list of the steps it completed, so undoing a macro executed
+    several times through a CommandHistory undoes every execution.
+    """
+    max_workers = 64
+
+    def __init__(self, commands, workers=None):
         self.commands = commands
+        self.workers = workers
+        # (command, undo state) of the last execution, in the order the commands completed.
+        self.completed = []
+        # The list handed out by undo_state, per thread, for the execution that follows.
+        self.local = threading.local()
+
+    def undo_state(self):
+        completed = self.local.completed = []
+        return completed
+
+    def lanes(self):
+        """
+        The commands grouped by device, keeping their order. Commands without a device get a lane each.
+        """
+        lanes = {}
+        for command in self.commands:
+            key = id(command.device) if command.device is not None else id(command)
+            lanes.setdefault(key, []).append(command)
+        return list(lanes.values())
 
     def execute(self):
-        for command in self.commands:
-            command.execute()
+        # One worker runs everything in the order given, which keeps the order of every device as well.
+        lanes = [self.commands] if self.workers == 1 else self.lanes()
+        completed = getattr(self.local, 'completed', None)
+        self.local.completed = None
+        if completed is None:
+            completed = []
+        lock = threading.Lock()
+        failures = []
+
+        def run(lanes):
+            for lane in lanes:
+                for command in lane:
+                    if failures:
+                        return
+                    state = command.undo_state()
+                    try:
+                        command.execute()
+                    except Exception as e:
+                        with lock:
+                            failures.append((command, e))
+                        return
+                    with lock:
+                        completed.append((command, state))
+
+        workers = min(self.workers or self.max_workers, len(lanes))
+        if workers <= 1:
+            run(lanes)
+        else:
+            # Every worker takes its share of the lanes, so a scene of thousands of devices is not
+            # thousands of tasks.
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                list(pool.map(run, [lanes[i::workers] for i in range(workers)]))
+        if failures:
+            rollback_errors = self.rollback(completed)
+            self.completed = []
+            command, error = failures[0]
+            raise MacroFailedError(command, error, rollback_errors) from error
+        self.completed = completed
 
     def undo(self):
-        for command in self.commands:
-            command.undo()
+        completed, self.completed = self.completed, []
+        self.undo_to(completed)
+
+    def undo_to(self, completed):
+        errors = self.rollback(completed)
+        if errors:
+            raise RollbackError(errors)
+
+    @staticmethod
+    def rollback(completed):
+        """
+        Undo the completed steps, last first, emptying the list. A step failing to undo does not stop the
+        others; the failures are returned as (command, error) pairs.
+        """
+        errors = []
+        while completed:
+            command, state = completed.pop()
+            try:
+                command.undo_to(state)
+            except Exception as e:
+                errors.append((command, e))
+        return errors
+
+
+class PartyOnMacroCommand(MacroCommand):
+    pass
+
+
+class PartyOffMacroCommand(MacroCommand):
+    pass
+
+
+class HistoryRecord:
+    __slots__ = ('command', 'state')
+
+    def __init__(self, command, state):
+        self.command = command
+        self.state = state
+
+
+class CommandHistory:
+    """
+    Bounded undo/redo history. The records of the executed commands sit in a ring buffer of `capacity`
+    slots: pushing and popping are O(1), and once it is full the oldest record is overwritten.
+    Every record keeps the state its command needs to be undone, so the same command object can be
+    used from several slots without one execution clobbering the undo state of another.
+    """
+
+    def __init__(self, capacity=100, journal=None):
+        if capacity < 1:
+            raise ValueError("The history must keep at least one command, got {}.".format(capacity))
+        self.capacity = capacity
+        self.journal = journal
+        self.records = [None] * capacity
+        self.start = 0
+        self.size = 0
+        self.redo_commands = []
+        self.lock = threading.RLock()
+
+    # The lock only guards the records: commands run outside of it, so that commands on different
+    # devices executed from several threads (e.g. the workers of a CommandQueue) run at the same time.
+
+    def execute(self, command):
+        record = HistoryRecord(command, command.undo_state())
+        command.execute()
+        if self.journal is not None:
+            self.journal.record(command)
+        with self.lock:
+            self._push(record)
+            self.redo_commands.clear()
+
+    def undo(self):
+        with self.lock:
+            if not self.size:
+                return False
+            record = self._pop()
+        record.command.undo_to(record.state)
+        if self.journal is not None:
+            self.journal.record(record.command)
+        with self.lock:
+            self.redo_commands.append(record.command)
+        return True
+
+    def redo(self):
+        with self.lock:
+            if not self.redo_commands:
+                return False
+            command = self.redo_commands.pop()
+        record = HistoryRecord(command, command.undo_state())
+        command.execute()
+        if self.journal is not None:
+            self.journal.record(command)
+        with self.lock:
+            self._push(record)
+        return True
+
+    def last(self):
+        with self.lock:
+            return self.records[(self.start + self.size - 1) % self.capacity] if self.size else None
+
+    def compact(self):
+        """
+        Merge every run of records restoring the captured state of the same device into the first record
+        of the run: undoing the run at once still restores the state from before it, one record per run.
+        """
+        with self.lock:
+            compacted = []
+            for record in self:
+                previous = compacted[-1] if compacted else None
+                if (previous is not None and record.state is not None and previous.state is not None and
+                        record.command.device is not None and record.command.device is previous.command.device):
+                    previous.command = record.command
+                else:
+                    compacted.append(HistoryRecord(record.command, record.state))
+            self.records = [None] * self.capacity
+            self.start = 0
+            self.size = 0
+            for record in compacted:
+                self._push(record)
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        for i in range(self.size):
+            yield self.records[(self.start + i) % self.capacity]
+
+    def _push(self, record):
+        self.records[(self.start + self.size) % self.capacity] = record
+        if self.size == self.capacity:
+            self.start = (self.start + 1) % self.capacity
+        else:
+            self.size += 1
+
+    def _pop(self):
+        self.size -= 1
+        index = (self.start + self.size) % self.capacity
+        record, self.records[index] = self.records[index], None
+        return record
+
+
+def device_name(device):
+    return device.location if isinstance(device, CeilingFan) else device.name
+
+
+class CommandJournal:
+    """
+    Append-only binary journal of the device states set by the executed commands, so that they survive
+    restarts. Recording a command only appends a few bytes to an in-memory buffer; a background thread
+    writes the buffer and fsyncs it every `commit_interval` seconds, one fsync for the whole group.
+    The journal is split into segments of `snapshot_every` records, and every segment starts with a
+    snapshot of all the devices, so a replay only needs the latest complete segment.
+
+    Records:  device  B kind, I id, H name length, name (utf-8)
+              state   B kind, I id, b state (the fan speed, or 1/0 for on/off)
+              end of the snapshot at the start of the segment: B kind
+    """
+    DEVICE = 1
+    STATE = 2
+    SNAPSHOT = 3
+    DEVICE_RECORD = struct.Struct('<BIBH')
+    STATE_RECORD = struct.Struct('<BIb')
+    KINDS = (Light, MusicPlayer, CeilingFan)
+
+    def __init__(self, directory, snapshot_every=100000, commit_interval=0.005, keep_segments=None):
+        if keep_segments is not None and keep_segments < 1:
+            raise ValueError("The journal must keep at least one segment, got {}.".format(keep_segments))
+        self.directory = directory
+        self.snapshot_every = snapshot_every
+        self.commit_interval = commit_interval
+        self.keep_segments = keep_segments
+        self.lock = threading.Lock()
+        self.commit_lock = threading.Lock()
+        # id(device) -> (journal id, device), and (kind, name) -> journal id to recognize devices after a restart
+        self.devices = {}
+        self.ids = {}
+        self.names = []
+        self.states = {}
+        self.commits = 0
+        for (kind, name), state in self.replay().items():
+            self.ids[kind, name] = len(self.names)
+            self.names.append((kind, name))
+            self.states[self.ids[kind, name]] = state
+        segments = self.segments()
+        self.segment = int(os.path.basename(segments[-1]).split('.')[0]) if segments else 0
+        self.file = None
+        self.file_segment = None
+        self.chunks = []
+        self._rotate()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._commit_periodically, daemon=True)
+        self.thread.start()
+
+    @staticmethod
+    def device_state(device):
+        return device.speed if isinstance(device, CeilingFan) else int(device.on)
+
+    def kind(self, device):
+        for kind in self.KINDS:
+            if isinstance(device, kind):
+                return kind
+        raise TypeError("Cannot journal a {}.".format(type(device).__name__))
+
+    def record(self, command):
+        device = command.device
+        if device is None:
+            # Macros journal the devices of their commands.
+            for command in getattr(command, 'commands', ()):
+                self.record(command)
+            return
+        state = self.device_state(device)
+        with self.lock:
+            entry = self.devices.get(id(device))
+            journal_id = entry[0] if entry is not None else self._declare(device)
+            self.states[journal_id] = state
+            self.buffer += self.STATE_RECORD.pack(self.STATE, journal_id, state)
+            self.records += 1
+            if self.records >= self.snapshot_every:
+                self._rotate()
+
+    def commit(self):
+        """
+        Write everything recorded so far to disk and fsync it.
+        """
+        with self.commit_lock:
+            with self.lock:
+                chunks, self.chunks = self.chunks, []
+                if self.buffer:
+                    chunks.append((self.segment, self.buffer))
+                    self.buffer = bytearray()
+            for segment, data in chunks:
+                if self.file is None or self.file_segment != segment:
+                    self._open(segment)
+                self.file.write(data)
+                self.file.flush()
+                os.fsync(self.file.fileno())
+            if chunks:
+                self.commits += 1
+                # The first chunk of a segment starts with its whole snapshot: once a chunk is fsynced, the
+                # snapshot of its segment is durable and the segments before it can go.
+                self._prune(chunks[-1][0])
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
+        self.commit()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def segments(self):
+        return sorted(
+            os.path.join(self.directory, name) for name in os.listdir(self.directory) if name.endswith('.journal'))
+
+    def replay(self, full=False):
+        """
+        Rebuild the state of every device journaled: {(kind, name): state}. Unless `full` is set, segments
+        before the latest one with a complete snapshot are skipped.
+        """
+        segments = []
+        for path in reversed(self.segments()):
+            segment_states, complete = self.read_segment(path)
+            segments.append(segment_states)
+            if complete and not full:
+                break
+        states = {}
+        for segment_states in reversed(segments):
+            states.update(segment_states)
+        return states
+
+    def read_segment(self, path):
+        """
+        The device states in a segment and whether its snapshot is complete. A torn record at the end of
+        the segment, left by a crash in the middle of a write, ends the segment.
+        """
+        states = {}
+        complete = False
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if not size:
+                return states, complete
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                names = {}
+                state_record = self.STATE_RECORD
+                device_record = self.DEVICE_RECORD
+                offset = 0
+                while offset < size:
+                    record = data[offset]
+                    if record == self.STATE:
+                        if offset + state_record.size > size:
+                            break
+                        _, journal_id, state = state_record.unpack_from(data, offset)
+                        states[names[journal_id]] = state
+                        offset += state_record.size
+                    elif record == self.DEVICE:
+                        if offset + device_record.size > size:
+                            break
+                        _, journal_id, kind, length = device_record.unpack_from(data, offset)
+                        offset += device_record.size
+                        if offset + length > size:
+                            break
+                        names[journal_id] = (self.KINDS[kind], data[offset:offset + length].decode('utf-8'))
+                        offset += length
+                    elif record == self.SNAPSHOT:
+                        complete = True
+                        offset += 1
+                    else:
+                        break
+        return states, complete
+
+    def restore(self, devices, states=None):
+        """
+        Set the devices to their journaled state, without going through their (printing) operations.
+        """
+        states = self.replay() if states is None else states
+        for device in devices:
+            state = states.get((self.kind(device), device_name(device)))
+            if state is None:
+                continue
+            if isinstance(device, CeilingFan):
+                device.speed = state
+            else:
+                device.on = bool(state)
+
+    def _declare(self, device):
+        kind = self.kind(device)
+        key = (kind, device_name(device))
+        journal_id = self.ids.get(key)
+        if journal_id is None:
+            journal_id = self.ids[key] = len(self.names)
+            self.names.append(key)
+            self.buffer += self._device_record(journal_id)
+        self.devices[id(device)] = (journal_id, device)
+        return journal_id
+
+    def _device_record(self, journal_id):
+        kind, name = self.names[journal_id]
+        name = name.encode('utf-8')
+        return self.DEVICE_RECORD.pack(self.DEVICE, journal_id, self.KINDS.index(kind), len(name)) + name
+
+    def _rotate(self):
+        # Called with the lock held: the snapshot is the state at this very point of the journal.
+        if self.file is not None or self.chunks:
+            self.chunks.append((self.segment, self.buffer))
+        self.segment += 1
+        self.records = 0
+        snapshot = bytearray()
+        for journal_id in range(len(self.names)):
+            snapshot += self._device_record(journal_id)
+            if journal_id in self.states:
+                snapshot += self.STATE_RECORD.pack(self.STATE, journal_id, self.states[journal_id])
+        snapshot.append(self.SNAPSHOT)
+        self.buffer = snapshot
+
+    def _open(self, segment):
+        if self.file is not None:
+            self.file.close()
+        self.file = open(os.path.join(self.directory, '{:08d}.journal'.format(segment)), 'ab')
+        self.file_segment = segment
+        # Make the new segment itself durable, not only its content.
+        directory = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+
+    def _prune(self, durable):
+        """
+        Keep the `keep_segments` newest segments with a durable snapshot (up to segment `durable`),
+        and every segment after them.
+        """
+        if not self.keep_segments:
+            return
+        complete = [path for path in self.segments() if int(os.path.basename(path).split('.')[0]) <= durable]
+        for path in complete[:-self.keep_segments]:
+            os.remove(path)
+
+    def _commit_periodically(self):
+        while not self.stopped.wait(self.commit_interval):
+            self.commit()
+
+
+class DeviceIndex:
+    """
+    Finds the slots of a remote by the name (or location) of their device and by group, e.g. "floor 3".
+    Every name and group maps to a sorted array of slot numbers: 4 bytes per slot instead of a list of
+    references. Slots are usually added in increasing order, which makes adding one an append.
+    """
+
+    def __init__(self):
+        self.names = {}
+        self.groups = {}
+
+    def add(self, slot, name, groups=()):
+        if name is not None:
+            self._insert(self.names, name, slot)
+        for group in groups:
+            self._insert(self.groups, group, slot)
+
+    def remove(self, slot, name):
+        """
+        Take the slot out of the index when it is reassigned. The groups are few, so all of them are searched.
+        """
+        if name is not None:
+            self._discard(self.names, name, slot)
+        for group in list(self.groups):
+            self._discard(self.groups, group, slot)
+
+    # find and select return copies: changing what they return must not change the index.
+
+    def find(self, name):
+        return array('I', self.names.get(name, ()))
+
+    def select(self, *groups):
+        """
+        The slots in all of the groups, in slot order.
+        """
+        members = sorted((self.groups.get(group, array('I')) for group in groups), key=len)
+        if not members:
+            return array('I')
+        if len(members) == 1:
+            return array('I', members[0])
+        return array('I', sorted(set(members[0]).intersection(*members[1:])))
+
+    def nbytes(self):
+        return sum(slots.itemsize * len(slots) for index in (self.names, self.groups) for slots in index.values())
+
+    @staticmethod
+    def _insert(index, key, slot):
+        slots = index.get(key)
+        if slots is None:
+            slots = index[key] = array('I')
+        if not slots or slots[-1] < slot:
+            slots.append(slot)
+        else:
+            bisect.insort(slots, slot)
+
+    @staticmethod
+    def _discard(index, key, slot):
+        slots = index.get(key)
+        if slots is None:
+            return
+        position = bisect.bisect_left(slots, slot)
+        if position < len(slots) and slots[position] == slot:
+            del slots[position]
+            if not slots:
+                del index[key]
 
 
 class RemoteControl:
 
-    def __init__(self, slots=1):
+    def __init__(self, slots=1, history=100, journal=None):
         self.on_button_slots = [None] * slots
         self.off_button_slots = [None] * slots
-        self.undo_command = None
-
-    def set_command(self, slot_index, on_command, off_command):
+        self.history = CommandHistory(history, journal)
+        self.index = DeviceIndex()
+
+    @property
+    def undo_command(self):
+        last = self.history.last()
+        return last.command if last is not None else None
+
+    def set_command(self, slot_index, on_command, off_command, groups=()):
+        """
+        Assign the commands to the slot, adding slots as needed, and index the slot under the name of
+        the device and the groups given. Setting both commands to None clears the slot.
+        """
+        if slot_index < 0:
+            raise IndexError("Slot indexes start at 0, got {}.".format(slot_index))
+        if slot_index >= len(self.on_button_slots):
+            missing = slot_index + 1 - len(self.on_button_slots)
+            self.on_button_slots.extend([None] * missing)
+            self.off_button_slots.extend([None] * missing)
+        elif self.on_button_slots[slot_index] is not None or self.off_button_slots[slot_index] is not None:
+            self.index.remove(slot_index, self.slot_name(slot_index))
         self.on_button_slots[slot_index] = on_command
         self.off_button_slots[slot_index] = off_command
+        if on_command is not None or off_command is not None:
+            self.index.add(slot_index, self.slot_name(slot_index), groups)
+
+    def slot_name(self, slot_index):
+        for command in (self.on_button_slots[slot_index], self.off_button_slots[slot_index]):
+            if command is not None and command.device is not None:
+                return device_name(command.device)
+        return None
+
+    def add_device(self, on_command, off_command, groups=()):
+        """
+        Assign the commands to a new slot and return it.
+        """
+        slot_index = len(self.on_button_slots)
+        self.set_command(slot_index, on_command, off_command, groups)
+        return slot_index
+
+    def find(self, name):
+        return self.index.find(name)
 
     def press_on_button(self, slot_index):
-        self.on_button_slots[slot_index].execute()
-        self.undo_command = self.on_button_slots[slot_index]
+        self.history.execute(self.on_button_slots[slot_index])
 
     def press_off_button(self, slot_index):
-        self.off_button_slots[slot_index].execute()
-        self.undo_command = self.off_button_slots[slot_index]
+        self.history.execute(self.off_button_slots[slot_index])
+
+    def press_on_group(self, *groups, workers=None):
+        return self.press_group(self.on_button_slots, groups, workers)
+
+    def press_off_group(self, *groups, workers=None):
+        return self.press_group(self.off_button_slots, groups, workers)
+
+    def press_group(self, buttons, groups, workers=None):
+        """
+        Press the buttons of every slot in all of the groups as one macro: one batch, one step to undo.
+        `workers` is passed on to the macro; one worker is fastest for devices that answer right away.
+        Returns the number of buttons pressed: slots without a command for the button are skipped.
+        """
+        commands = [buttons[slot] for slot in self.index.select(*groups) if buttons[slot] is not None]
+        if commands:
+            self.history.execute(MacroCommand(commands, workers))
+        return len(commands)
 
     def undo_button(self):
-        self.undo_command.undo()
+        return self.history.undo()
+
+    def redo_button(self):
+        return self.history.redo()
+
+
+class CommandQueue:
+    """
+    Executes commands asynchronously in batches, in front of a RemoteControl.
+    Commands waiting for the same device are merged: every command sets the state of its device, so
+    only the last one submitted matters (e.g. low, high, medium for a fan runs medium only).
+    Every device is bound to one worker, so the commands of a device run in the order submitted.
+    Commands without a device (macros) are barriers: they run alone, once everything submitted before
+    them has run, and nothing submitted after them is merged with what came before.
+    """
+
+    def __init__(self, remote=None, workers=4, flush_interval=0.005):
+        self.remote = remote
+        self.flush_interval = flush_interval
+        self.pending = {}
+        self.condition = threading.Condition()
+        self.outstanding = 0
+        self.closed = False
+        self.submitted = 0
+        self.merged = 0
+        self.executed = 0
+        self.batches = 0
+        # Bumped by every command without a device, so that later commands are not merged across it.
+        self.epoch = 0
+        # id(device) -> worker. Handed out round-robin: ids are aligned, so their hash would pick few workers.
+        self.lanes = {}
+        self.worker_queues = [queue.Queue() for _ in range(workers)]
+        self.threads = [threading.Thread(target=self._work, args=(q,), daemon=True) for q in self.worker_queues]
+        self.threads.append(threading.Thread(target=self._dispatch, daemon=True))
+        for thread in self.threads:
+            thread.start()
+
+    def press_on_button(self, slot_index):
+        self.submit(self.remote.on_button_slots[slot_index])
+
+    def press_off_button(self, slot_index):
+        self.submit(self.remote.off_button_slots[slot_index])
+
+    def submit(self, command):
+        with self.condition:
+            if self.closed:
+                raise ValueError("The command queue has been closed.")
+            if command.device is not None:
+                key = (self.epoch, id(command.device))
+            else:
+                self.epoch += 1
+                key = (self.epoch, None)
+            self.submitted += 1
+            if key in self.pending:
+                self.merged += 1
+            else:
+                self.outstanding += 1
+            self.pending[key] = command
+            self.condition.notify_all()
+
+    def join(self):
+        """
+        Wait until every submitted command has been executed.
+        """
+        with self.condition:
+            while self.outstanding:
+                self.condition.wait()
+
+    def close(self):
+        self.join()
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        for q in self.worker_queues:
+            q.put(None)
+        for thread in self.threads:
+            thread.join()
+
+    def _dispatch(self):
+        while True:
+            with self.condition:
+                while not self.pending and not self.closed:
+                    self.condition.wait()
+                if self.closed and not self.pending:
+                    return
+            # Give the storm a moment to pile up, so that more commands get merged.
+            time.sleep(self.flush_interval)
+            with self.condition:
+                batch, self.pending = self.pending, {}
+                self.batches += 1
+            for command in batch.values():
+                if command.device is None:
+                    for q in self.worker_queues:
+                        q.join()
+                    self._execute(command)
+                    continue
+                lane = self.lanes.get(id(command.device))
+                if lane is None:
+                    lane = self.lanes[id(command.device)] = len(self.lanes) % len(self.worker_queues)
+                self.worker_queues[lane].put(command)
+
+    def _work(self, commands):
+        while True:
+            command = commands.get()
+            if command is None:
+                return
+            self._execute(command)
+            commands.task_done()
+
+    def _execute(self, command):
+        try:
+            if self.remote is not None:
+                # Recorded in the history of the remote, so that queued presses can be undone too.
+                self.remote.history.execute(command)
+            else:
+                command.execute()
+        except Exception as e:
+            print("Failed to execute {}: {}".format(command.__class__.__name__, e))
+        with self.condition:
+            self.outstanding -= 1
+            self.executed += 1
+            self.condition.notify_all()
+
+
+class _SlowCeilingFan(CeilingFan):
+    """
+    A fan behind a network call taking `latency` seconds.
+    """
+
+    def __init__(self, location, latency):
+        super().__init__(location)
+        self.latency = latency
+
+    def delay(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def high(self):
+        self.delay()
+        super().high()
+
+    def medium(self):
+        self.delay()
+        super().medium()
+
+    def low(self):
+        self.delay()
+        super().low()
+
+    def off(self):
+        self.delay()
+        super().off()
+
+
+class _BrokenLight(Light):
+
+    def turn_on(self):
+        raise IOError("{} light is not responding".format(self.name))
+
+
+def benchmark_scene(devices=50, latency=0.02):
+    """
+    A party scene switching many slow fans, run one device after the other and then concurrently.
+    """
+    fans = [_SlowCeilingFan("Room {}".format(i), latency) for i in range(devices)]
+    commands = [CeilingFanHighCommand(fan) for fan in fans]
+    for workers in (1, None):
+        scene = PartyOnMacroCommand(commands, workers=workers)
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            scene.execute()
+            elapsed = time.perf_counter() - start
+            scene.undo()
+        print("{} devices taking {} ms, {}: {:.0f} ms".format(
+            devices, latency * 1000, "sequential" if workers == 1 else "concurrent", elapsed * 1000))
+
+
+def benchmark_journal(commands=300000, devices=1000, snapshot_every=100000):
+    """
+    The cost of journaling a command, and how long recovering the devices takes with and without snapshots.
+    """
+    rng = random.Random(0)
+    fans = [CeilingFan("Room {}".format(i)) for i in range(devices)]
+    storm = [rng.choice([CeilingFanLowCommand(fan), CeilingFanHighCommand(fan), CeilingFanOffCommand(fan)])
+             for fan in fans for _ in range(commands // devices)]
+    rng.shuffle(storm)
+    with tempfile.TemporaryDirectory() as directory:
+        journal = CommandJournal(directory, snapshot_every=snapshot_every)
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            start = time.perf_counter()
+            for command in storm:
+                command.execute()
+            direct = time.perf_counter() - start
+            start = time.perf_counter()
+            for command in storm:
+                command.execute()
+                journal.record(command)
+            journaled = time.perf_counter() - start
+        journal.close()
+        size = sum(os.path.getsize(path) for path in journal.segments())
+        print("{} commands: {:.2f} us per command, {:.2f} us journaled, {} group commits, {} KiB in {} segments".format(
+            len(storm), direct / len(storm) * 1e6, journaled / len(storm) * 1e6, journal.commits, size // 1024,
+            len(journal.segments())))
+        for full in (True, False):
+            recovered = [CeilingFan(fan.location) for fan in fans]
+            start = time.perf_counter()
+            journal.restore(recovered, journal.replay(full=full))
+            elapsed = time.perf_counter() - start
+            print("Recovery {}: {:.0f} ms, every fan restored: {}".format(
+                "from the first segment" if full else "from the latest snapshot", elapsed * 1000,
+                all(fan.speed == restored.speed for fan, restored in zip(fans, recovered))))
+
+
+def benchmark_registry(devices=100000, floors=20, lookups=10000):
+    """
+    A building of lights and fans: indexing, lookups by name and group, and group dispatch at scale.
+    """
+    remote = RemoteControl(slots=0)
+    start = time.perf_counter()
+    for i in range(devices):
+        floor = "floor {}".format(i % floors)
+        if i % 4:
+            light = Light("Light {}".format(i))
+            remote.add_device(LightsOnCommand(light), LightsOffCommand(light), (floor, "lights"))
+        else:
+            fan = CeilingFan("Room {}".format(i))
+            remote.add_device(CeilingFanHighCommand(fan), CeilingFanOffCommand(fan), (floor, "fans"))
+    elapsed = time.perf_counter() - start
+    print("{} devices added in {:.0f} ms, index: {} bytes per slot".format(
+        devices, elapsed * 1000, remote.index.nbytes() // devices))
+    name = "Light {}".format(devices - 1)
+    print("Lookup by name: {:.2f} us".format(
+        timeit.timeit(lambda: remote.find(name), number=lookups) / lookups * 1e6))
+    print("Lights on floor 3: {:.0f} us".format(
+        timeit.timeit(lambda: remote.index.select("floor 3", "lights"), number=100) / 100 * 1e6))
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        slots = remote.index.select("lights")
+        start = time.perf_counter()
+        for slot in slots:
+            remote.press_on_button(slot)
+        one_by_one = time.perf_counter() - start
+        groups = []
+        for workers in (1, None):
+            start = time.perf_counter()
+            remote.press_off_group("lights", workers=workers)
+            groups.append(time.perf_counter() - start)
+            remote.undo_button()
+    print("{} lights: {:.0f} ms pressed one by one, as one group: {:.0f} ms on one worker, {:.0f} ms on {}".format(
+        len(slots), one_by_one * 1000, groups[0] * 1000, groups[1] * 1000, MacroCommand.max_workers))
+    print("All on after undoing the groups: {}".format(all(remote.on_button_slots[slot].device.on for slot in slots)))
+
+
+def benchmark_history(steps=1000000, capacity=1000):
+    """
+    Replay a long session through a bounded history and show that its memory stays flat.
+    """
+    fan = CeilingFan("Replay")
+    commands = [CeilingFanLowCommand(fan), CeilingFanMediumCommand(fan), CeilingFanHighCommand(fan)]
+    history = CommandHistory(capacity)
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        tracemalloc.start()
+        start = time.perf_counter()
+        for step in range(steps):
+            history.execute(commands[step % 3])
+            if step == capacity:
+                filled, _ = tracemalloc.get_traced_memory()
+        elapsed = time.perf_counter() - start
+        current, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        undone = sum(history.undo() for _ in range(capacity + 1))
+    print("{} steps in {:.2f}s, history memory after {} steps: {} KiB, after {}: {} KiB, {} undoable".format(
+        steps, elapsed, capacity, filled // 1024, steps, current // 1024, undone))
+
+
+def benchmark_press_storm(fans=100, presses=50000, workers=4, latency=0):
+    rng = random.Random(0)
+    devices = [_SlowCeilingFan("Room {}".format(i), latency) for i in range(fans)]
+    commands = [
+        [CeilingFanLowCommand(fan), CeilingFanMediumCommand(fan), CeilingFanHighCommand(fan), CeilingFanOffCommand(fan)]
+        for fan in devices
+    ]
+    storm = [rng.choice(commands[rng.randrange(fans)]) for _ in range(presses)]
+    expected = {}
+    for command in storm:
+        expected[command.fan] = command
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        for command in storm:
+            command.execute()
+        direct = time.perf_counter() - start
+        for fan in devices:
+            fan.speed = CeilingFan.OFF
+        command_queue = CommandQueue(workers=workers)
+        start = time.perf_counter()
+        for command in storm:
+            command_queue.submit(command)
+        command_queue.join()
+        queued = time.perf_counter() - start
+        command_queue.close()
+    print("{} presses on devices taking {} ms".format(presses, latency * 1000))
+    print("Direct: {:.0f} presses/s".format(presses / direct))
+    print("Queued: {:.0f} presses/s, {} executed in {} batches, {} merged".format(
+        presses / queued, command_queue.executed, command_queue.batches, command_queue.merged))
+    print("Every fan ended at the last speed pressed: {}".format(
+        all(fan.speed == {CeilingFanLowCommand: CeilingFan.LOW, CeilingFanMediumCommand: CeilingFan.MEDIUM,
+                          CeilingFanHighCommand: CeilingFan.HIGH, CeilingFanOffCommand: CeilingFan.OFF}[type(command)]
+            for fan, command in expected.items())))
 
 
 if __name__ == '__main__':
@@ -241,8 +1168,68 @@ if __name__ == '__main__':
     music_off = MusicOffCommand(music_player)
     party_on_commands = [lights_on, fan_high, music_on]
     party_off_commands = [lights_off, fan_off, music_off]
-    party_on = PartyOnMacroCommand(party_on_commands)
-    party_off = PartyOffMacroCommand(party_off_commands)
+    # One worker keeps the printed lines of the devices from interleaving; see benchmark_scene for the concurrent run.
+    party_on = PartyOnMacroCommand(party_on_commands, workers=1)
+    party_off = PartyOffMacroCommand(party_off_commands, workers=1)
     remote.set_command(4, party_on, party_off)
     remote.press_on_button(4)
     remote.press_off_button(4)
+    remote.undo_button()
+    print("--- Rolled back party ---")
+    broken_party = PartyOnMacroCommand([fan_high, music_on, LightsOnCommand(_BrokenLight("Garden"))], workers=1)
+    try:
+        broken_party.execute()
+    except MacroFailedError as e:
+        print(e)
+    print("--- History ---")
+    remote.press_on_button(1)
+    remote.press_on_button(3)
+    remote.press_on_button(2)
+    remote.undo_button()
+    remote.undo_button()
+    remote.redo_button()
+    print("--- Journal ---")
+    with tempfile.TemporaryDirectory() as directory:
+        journal = CommandJournal(directory)
+        journaled_remote = RemoteControl(slots=5, journal=journal)
+        for slot in range(5):
+            journaled_remote.set_command(slot, remote.on_button_slots[slot], remote.off_button_slots[slot])
+        journaled_remote.press_on_button(3)
+        journaled_remote.press_on_button(0)
+        journaled_remote.press_off_button(4)
+        journaled_remote.undo_button()
+        journal.close()
+        # After a restart: new devices, restored from the journal.
+        restarted = [Light("Kitchen"), CeilingFan("Bathroom"), MusicPlayer("CD Player")]
+        journal = CommandJournal(directory)
+        journal.restore(restarted)
+        journal.close()
+        print("Restored: Kitchen light on: {}, Bathroom fan speed: {}, CD Player on: {}".format(
+            restarted[0].on, restarted[1].speed, restarted[2].on))
+    print("--- Groups ---")
+    building = RemoteControl(slots=0)
+    for floor in (1, 2):
+        for room in ("Kitchen", "Bathroom"):
+            light = Light("{} {}".format(room, floor))
+            building.add_device(LightsOnCommand(light), LightsOffCommand(light), ("floor {}".format(floor), "lights"))
+        fan = CeilingFan("Bathroom {}".format(floor))
+        building.add_device(CeilingFanHighCommand(fan), CeilingFanOffCommand(fan), ("floor {}".format(floor), "fans"))
+    print("Bathroom 2 is in slots {}".format(list(building.find("Bathroom 2"))))
+    building.press_on_group("floor 2", "lights", workers=1)
+    building.undo_button()
+    building.set_command(4, CeilingFanHighCommand(fan), CeilingFanOffCommand(fan), ("floor 2", "fans"))
+    print("Bathroom 2 after reassigning slot 4: {}, fans on floor 2: {}".format(
+        list(building.find("Bathroom 2")), list(building.index.select("floor 2", "fans"))))
+    print("--- Command queue ---")
+    command_queue = CommandQueue(remote)
+    command_queue.press_on_button(1)
+    command_queue.press_on_button(3)
+    command_queue.press_on_button(2)
+    command_queue.press_on_button(0)
+    command_queue.close()
+    benchmark_press_storm()
+    benchmark_press_storm(presses=2000, latency=0.0005)
+    benchmark_scene()
+    benchmark_journal()
+    benchmark_registry()
+    benchmark_history()
@@ -5,6 +5,15 @@ Design principle enforced: Dependency Inversion
 """
 
 import abc
+import functools
+import importlib
+import math
+import time
+import timeit
+import tracemalloc
+import weakref
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 
 """
 Use case:
@@ -12,13 +21,113 @@ There are many varieties of pizzas. Each Pizza Store specializes in some specifi
 """
 
 
+class UnknownPizzaError(LookupError):
+    pass
+
+
+class PizzaRegistry(object):
+    """
+    Maps pizza types to the products a store makes, replacing if-chains with one dict lookup.
+    A product is a class (or any callable) or a "module:attribute" string imported on first use.
+    """
+
+    def __init__(self, store, products=None):
+        self.store = store
+        self.products = dict(products or {})
+        # The stores making pizzas from this registry: a registration clears their prototypes.
+        self.stores = weakref.WeakSet()
+
+    def register(self, type, product=None):
+        """
+        Register a product for the type. Without a product it returns a class decorator.
+        """
+        if product is None:
+            def decorator(product):
+                return self.register(type, product)
+
+            return decorator
+        if isinstance(product, str) and not all(product.partition(':')[::2]):
+            raise ValueError("The {} product {!r} is not a 'module:attribute' string.".format(type, product))
+        self.products[type] = product
+        if self.stores:
+            for store in self.stores:
+                store.prototypes.pop(type, None)
+        return product
+
+    def resolve(self, type):
+        try:
+            product = self.products[type]
+        except KeyError:
+            raise UnknownPizzaError("The {} store does not make {!r} pizzas.".format(self.store, type)) from None
+        if isinstance(product, str):
+            module, _, attribute = product.partition(':')
+            try:
+                product = getattr(importlib.import_module(module), attribute)
+            except (ImportError, AttributeError) as e:
+                raise UnknownPizzaError("The {} store cannot load {!r} pizzas from {!r}: {}".format(
+                    self.store, type, product, e)) from e
+            self.products[type] = product
+        return product
+
+    def create(self, type, *args):
+        return self.resolve(type)(*args)
+
+    def __contains__(self, type):
+        return type in self.products
+
+    def __len__(self):
+        return len(self.products)
+
+
+OrderResult = namedtuple('OrderResult', ['type', 'pizza', 'steps'])
+
+
 class PizzaStore(metaclass=abc.ABCMeta):
+    # The registry create_pizza makes the pizzas from, if any: its changes invalidate the prototypes.
+    pizzas = None
+
+    def __init__(self):
+        # type -> the pizza every order of that type is cloned from
+        self.prototypes = {}
+        if self.pizzas is not None:
+            self.pizzas.stores.add(self)
+
     def order_pizza(self, type):
         pizza = self.create_pizza(type)
-        pizza.prepare()
-        pizza.bake()
-        pizza.cut()
-        pizza.pack()
+        if pizza is None:
+            raise UnknownPizzaError("{} does not make {!r} pizzas.".format(self.__class__.__name__, type))
+        print(pizza.prepare())
+        print(pizza.bake())
+        print(pizza.cut())
+        print(pizza.pack())
+
+    def order_many(self, orders, ovens=4):
+        """
+        Make a batch of orders. Every type is created once as a prototype that the orders of that type
+        are copied from, and up to `ovens` pizzas bake at the same time. Nothing is printed: the result
+        holds what every step did, one OrderResult per order in the order given.
+        """
+        orders = list(orders)
+        pizzas = [self.clone_pizza(type) for type in orders]
+        prepared = [pizza.prepare() for pizza in pizzas]
+        with ThreadPoolExecutor(max_workers=ovens) as oven:
+            baked = list(oven.map(lambda pizza: pizza.bake(), pizzas))
+        return [
+            OrderResult(type, pizza, (prepare, bake, pizza.cut(), pizza.pack()))
+            for type, pizza, prepare, bake in zip(orders, pizzas, prepared, baked)
+        ]
+
+    def clone_pizza(self, type):
+        """
+        A new pizza of the type, cloned from a prototype that is created on the first order of the type.
+        """
+        prototype = self.prototypes.get(type)
+        if prototype is None:
+            prototype = self.create_pizza(type)
+            if prototype is None:
+                raise UnknownPizzaError("{} does not make {!r} pizzas.".format(self.__class__.__name__, type))
+            self.prototypes[type] = prototype
+        return prototype.clone()
 
     @abc.abstractmethod
     def create_pizza(self, type):
@@ -30,51 +139,146 @@ class Pizza(metaclass=abc.ABCMeta):
         self.name = None
         self.dough = "Standard dough"
         self.sauce = None
-        self.toppings = list()
+        self.toppings = ()
+
+    # The toppings are kept in a tuple that a prototype and its clones share, until one of them asks
+    # for its toppings list: that pizza then gets a list of its own.
+
+    @property
+    def toppings(self):
+        if self._toppings.__class__ is tuple:
+            self._toppings = list(self._toppings)
+        return self._toppings
+
+    @toppings.setter
+    def toppings(self, toppings):
+        self._toppings = tuple(toppings)
+
+    def add_toppings(self, *toppings):
+        # A shared tuple is replaced by a new one, a list of the pizza's own is extended.
+        self._toppings += toppings
+
+    def clone(self):
+        """
+        A shallow copy sharing the toppings with this pizza until either of them changes them.
+        """
+        clone = object.__new__(self.__class__)
+        clone.__dict__ = self.__dict__.copy()
+        if clone._toppings.__class__ is list:
+            clone._toppings = tuple(clone._toppings)
+        return clone
 
     def prepare(self):
-        print("Preparing pizza: {}".format(self.name))
-        print("Tossing dough: {}".format(self.dough))
-        print("Adding sauce: {}".format(self.sauce))
-        for topping in self.toppings:
-            print("Adding topping: {}".format(topping))
+        steps = [
+            "Preparing pizza: {}".format(self.name),
+            "Tossing dough: {}".format(self.dough),
+            "Adding sauce: {}".format(self.sauce),
+        ]
+        steps.extend("Adding topping: {}".format(topping) for topping in self._toppings)
+        return "\n".join(steps)
 
     def bake(self):
-        print("Baking at 250 for 10 mins")
+        return "Baking at 250 for 10 mins"
 
     def cut(self):
-        print("Cutting into 6 slices")
+        return "Cutting into 6 slices"
 
     def pack(self):
-        print("Packing in company standard boxes")
+        return "Packing in company standard boxes"
+
 
+new_york_pizzas = PizzaRegistry("New York")
+california_pizzas = PizzaRegistry("California")
 
+
+@new_york_pizzas.register('cheese')
 class NewYorkPizza(Pizza):
     def __init__(self):
         super().__init__()
         self.name = "New York Pizza"
         self.sauce = "sweet chilly sauce"
-        self.toppings.extend(["Basil", "Cheese", "Tomato"])
+        self.add_toppings("Basil", "Cheese", "Tomato")
 
 
+@california_pizzas.register('pineapple')
 class CaliforniaPizza(Pizza):
     def __init__(self):
         super().__init__()
         self.name = "California Pizza"
         self.sauce = "Tomato sauce"
-        self.toppings.extend(["Onion", "Corn", "Pineapple"])
+        self.add_toppings("Onion", "Corn", "Pineapple")
 
 
 class NewYorkPizzaStore(PizzaStore):
+    pizzas = new_york_pizzas
+
     def create_pizza(self, type):
-        if type == 'cheese':
-            return NewYorkPizza()
+        return self.pizzas.create(type)
 
 
 class CaliforniaPizzaStore(PizzaStore):
+    pizzas = california_pizzas
+
+    def create_pizza(self, type):
+        return self.pizzas.create(type)
+
+
+class _SlowBakePizza(NewYorkPizza):
+
+    def bake(self):
+        time.sleep(0.005)
+        return super().bake()
+
+
+class _BenchmarkPizzaStore(PizzaStore):
+    pizzas = PizzaRegistry("Benchmark", {'cheese': NewYorkPizza, 'slow': _SlowBakePizza})
+
     def create_pizza(self, type):
-        if type == 'pineapple':
-            return CaliforniaPizza()
+        return self.pizzas.create(type)
+
+
+def benchmark_order_many(store=None, orders=400, ovens=(1, 2, 4, 8, 16)):
+    store = store or _BenchmarkPizzaStore()
+    batch = ['slow', 'cheese'] * (orders // 2)
+    for capacity in ovens:
+        elapsed = timeit.timeit(lambda: store.order_many(batch, ovens=capacity), number=1)
+        print("{:>2} ovens: {:.0f} orders/s".format(capacity, orders / elapsed))
+
+
+def benchmark_prototypes(pizzas=100000, rounds=5):
+    """
+    Build batches of pizzas with the constructor and by cloning a prototype. The rounds alternate between
+    the two and the fastest round of each counts, as the machine may be busy with something else.
+    """
+    store = NewYorkPizzaStore()
+    makers = (('constructor', NewYorkPizza), ('prototype clone', functools.partial(store.clone_pizza, 'cheese')))
+    best = {name: math.inf for name, _ in makers}
+    for _ in range(rounds):
+        for name, make in makers:
+            start = time.perf_counter()
+            batch = [make() for _ in range(pizzas)]
+            best[name] = min(best[name], time.perf_counter() - start)
+            del batch
+    for name, make in makers:
+        # Measured apart from the timing, tracemalloc slows down every allocation.
+        tracemalloc.start()
+        batch = [make() for _ in range(pizzas)]
+        size, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del batch
+        print("{:>15}: {:.2f} us and {} bytes per pizza".format(name, best[name] / pizzas * 1e6, size // pizzas))
+
+
+def benchmark_registry(sizes=(10, 1000, 10000), lookups=100000):
+    for size in sizes:
+        registry = PizzaRegistry("Benchmark")
+        # Lazily imported products: registering them does not import anything.
+        register = timeit.timeit(
+            lambda: [registry.register('pizza {}'.format(i), __name__ + ':NewYorkPizza') for i in range(size)], number=1)
+        last = 'pizza {}'.format(size - 1)
+        registry.resolve(last)
+        lookup = timeit.timeit(lambda: registry.resolve(last), number=lookups) / lookups
+        print("{:>6} pizza types: registered in {:.2f} ms, {:.3f} us per lookup".format(size, register * 1000, lookup * 1e6))
 
 
 if __name__ == '__main__':
@@ -82,3 +286,18 @@ if __name__ == '__main__':
     pizza_store.order_pizza('cheese')
     cal_pizza_store = CaliforniaPizzaStore()
     cal_pizza_store.order_pizza('pineapple')
+    try:
+        cal_pizza_store.order_pizza('cheese')
+    except UnknownPizzaError as e:
+        print(e)
+    for result in pizza_store.order_many(['cheese', 'cheese']):
+        print(result.type, result.steps[1:])
+    extra_cheese = pizza_store.clone_pizza('cheese')
+    extra_cheese.toppings.append("Extra cheese")
+    print(extra_cheese.toppings, pizza_store.clone_pizza('cheese').toppings)
+    new_york_pizzas.register('cheese', CaliforniaPizza)
+    print("After registering a new cheese pizza: {}".format(pizza_store.clone_pizza('cheese').name))
+    new_york_pizzas.register('cheese', NewYorkPizza)
+    benchmark_registry()
+    benchmark_order_many()
+    benchmark_prototypes()
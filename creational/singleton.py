@@ -2,29 +2,898 @@
  Provide one and only one object of a particular type.
 """
 
+import abc
+import asyncio
+import bisect
+import contextlib
+import hashlib
+import json
+import math
+import mmap
+import multiprocessing
+import os
+import pickle
+import sqlite3
+import struct
+import sys
+import tempfile
+import threading
+import time
+import timeit
+import urllib.request
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
 """
 Use case:
 Implement a CacheClient which provides an interface to fetch cached data.
 """
 
 
-class Cache:
+class CacheShard(object):
+    """
+    One lock and one LRU ordered dict of key -> (value, expiry time, size in bytes, stale time).
+    The counters are only changed while the lock is held anyway, so counting takes no lock of its own.
+    """
+
+    def __init__(self, max_entries=None, max_bytes=None):
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key, default=None):
+        entry = self.get_entry(key)
+        return entry[0] if entry is not None else default
+
+    def get_entry(self, key, count=True):
+        """
+        (value, is the value stale) for a live entry, None otherwise.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += count
+                return None
+            value, expires, _, stale_at = entry
+            now = time.monotonic()
+            if expires is not None and expires <= now:
+                self._remove(key)
+                self.expirations += 1
+                self.misses += count
+                return None
+            self.entries.move_to_end(key)
+            self.hits += count
+            return value, stale_at is not None and stale_at <= now
+
+    def set(self, key, value, ttl=None, stale_after=None):
+        size = sys.getsizeof(key) + sys.getsizeof(value)
+        now = time.monotonic()
+        expires = now + ttl if ttl is not None else None
+        stale_at = now + stale_after if stale_after is not None else None
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = (value, expires, size, stale_at)
+            self.nbytes += size
+            self._evict()
+
+    def delete(self, key):
+        with self.lock:
+            if key not in self.entries:
+                return False
+            self._remove(key)
+            return True
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _remove(self, key):
+        _, _, size, _ = self.entries.pop(key)
+        self.nbytes -= size
+
+    def _evict(self):
+        # Least recently used first. The entry just set survives even when it alone is over the budget.
+        while len(self.entries) > 1 and (
+                (self.max_entries is not None and len(self.entries) > self.max_entries) or
+                (self.max_bytes is not None and self.nbytes > self.max_bytes)):
+            self._remove(next(iter(self.entries)))
+            self.evictions += 1
+
+
+class SharedMemoryShard(object):
+    """
+    A cache shard living in a memory mapped file, so that every process on the host opening the same
+    path shares one copy of the entries.
+
+    The file is a fixed-size open addressing hash table of slots:
+    sequence number, state, key hash, expiry time, stale time, key length, value length, key, value.
+    Keys and values are pickled. Writers serialize on an flock of the file and make the sequence number
+    odd while they change a slot; readers never lock, they retry when the sequence number changed
+    under them (a seqlock). A full probe window evicts its first slot, there is no LRU order across
+    processes. Times are wall clock times, comparable between processes.
+    A writer dying halfway leaves its slot odd for good. Readers spinning on it for too long take the
+    lock: a slot still odd while they hold it has no writer left, and is marked deleted.
+    The counters are those of this process only. Needs fcntl, i.e. a POSIX system.
+    """
+    MAGIC = b'OODCACHE'
+    HEADER = struct.Struct('<8sII')
+    SLOT = struct.Struct('<IIQddHI')
+    EMPTY, USED, DELETED = 0, 1, 2
+    # Retries of a lookup finding a writer busy in its window before the lookup takes the lock.
+    SPINS = 100
+
+    def __init__(self, path, slots=4096, slot_size=512, probes=8):
+        self.path = path
+        # flock serializes processes only: the threads of a process share the file, and its lock.
+        self.lock = threading.Lock()
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        with self._locked():
+            if os.fstat(self.fd).st_size == 0:
+                os.ftruncate(self.fd, self.HEADER.size + slots * slot_size)
+                os.pwrite(self.fd, self.HEADER.pack(self.MAGIC, slots, slot_size), 0)
+            magic, self.slots, self.slot_size = self.HEADER.unpack(os.pread(self.fd, self.HEADER.size, 0))
+        if magic != self.MAGIC:
+            raise ValueError("{} is not a shared cache file.".format(path))
+        self.probes = min(probes, self.slots)
+        self.map = mmap.mmap(self.fd, self.HEADER.size + self.slots * self.slot_size)
+        self.view = memoryview(self.map)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    @contextlib.contextmanager
+    def _locked(self):
+        import fcntl
+
+        with self.lock:
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    def _offset(self, slot):
+        return self.HEADER.size + slot * self.slot_size
+
+    def _window(self, key_hash):
+        return [(key_hash + i) % self.slots for i in range(self.probes)]
+
+    @staticmethod
+    def _hash(key_bytes):
+        # hash() is salted per process, the slots need a hash every process agrees on.
+        return int.from_bytes(hashlib.blake2b(key_bytes, digest_size=8).digest(), 'little')
+
+    def _read(self, slot, key_bytes, key_hash):
+        """
+        (value view, expires, stale_at, sequence number) of the slot if it holds the key, else None.
+        """
+        offset = self._offset(slot)
+        seq, state, slot_hash, expires, stale_at, key_len, value_len = self.SLOT.unpack_from(self.map, offset)
+        if seq % 2 or state != self.USED or slot_hash != key_hash or key_len != len(key_bytes):
+            return None
+        start = offset + self.SLOT.size
+        if self.view[start:start + key_len] != key_bytes:
+            return None
+        return self.view[start + key_len:start + key_len + value_len], expires, stale_at, seq
+
+    def _lookup(self, key, locked=False):
+        """
+        (slot, what _read found) for the key, or (None, None). `locked` tells that the caller holds the lock.
+        """
+        key_bytes = pickle.dumps(key)
+        key_hash = self._hash(key_bytes)
+        window = self._window(key_hash)
+        spins = 0
+        while True:
+            for slot in window:
+                found = self._read(slot, key_bytes, key_hash)
+                if found is not None:
+                    return slot, found
+                if self.SLOT.unpack_from(self.map, self._offset(slot))[1] == self.EMPTY:
+                    break
+            # Nothing found, unless a writer was busy with the window: then look again.
+            if all(self.SLOT.unpack_from(self.map, self._offset(slot))[0] % 2 == 0 for slot in window):
+                return None, None
+            spins += 1
+            if locked:
+                self._repair(window)
+            elif spins >= self.SPINS:
+                with self._locked():
+                    self._repair(window)
+            else:
+                time.sleep(0)
+
+    def _repair(self, slots):
+        # Called with the lock held: no writer is running, so an odd slot is the leftover of a dead one.
+        for slot in slots:
+            offset = self._offset(slot)
+            seq = self.SLOT.unpack_from(self.map, offset)[0]
+            if seq % 2:
+                self.SLOT.pack_into(self.map, offset, seq + 1, self.DELETED, 0, 0.0, 0.0, 0, 0)
+
+    def view_entry(self, key):
+        """
+        Zero-copy memoryview of the pickled value. The entry was whole when it was looked up, but nothing
+        keeps another process from writing the key while the view is being read: copy the bytes and use
+        get_entry when that matters. The view is only valid until the key is set or deleted again.
+        """
+        while True:
+            slot, found = self._lookup(key)
+            if found is None or (found[1] and found[1] <= time.time()):
+                return None
+            if self.SLOT.unpack_from(self.map, self._offset(slot))[0] == found[3]:
+                return found[0]
+
+    def get_entry(self, key, count=True):
+        while True:
+            slot, found = self._lookup(key)
+            if found is None:
+                self.misses += count
+                return None
+            value_view, expires, stale_at, seq = found
+            now = time.time()
+            if expires and expires <= now:
+                self.misses += count
+                return None
+            value = bytes(value_view)
+            if self.SLOT.unpack_from(self.map, self._offset(slot))[0] == seq:
+                self.hits += count
+                return pickle.loads(value), bool(stale_at) and stale_at <= now
+
+    def get(self, key, default=None):
+        entry = self.get_entry(key)
+        return entry[0] if entry is not None else default
+
+    def _write_slot(self, slot, state, key_hash=0, expires=0.0, stale_at=0.0, key_bytes=b'', value_bytes=b''):
+        offset = self._offset(slot)
+        seq = self.SLOT.unpack_from(self.map, offset)[0]
+        struct.pack_into('<I', self.map, offset, seq + 1)
+        start = offset + self.SLOT.size
+        self.map[start:start + len(key_bytes) + len(value_bytes)] = key_bytes + value_bytes
+        self.SLOT.pack_into(self.map, offset, seq + 1, state, key_hash, expires, stale_at, len(key_bytes), len(value_bytes))
+        struct.pack_into('<I', self.map, offset, seq + 2)
+
+    def set(self, key, value, ttl=None, stale_after=None):
+        key_bytes, value_bytes = pickle.dumps(key), pickle.dumps(value)
+        if self.SLOT.size + len(key_bytes) + len(value_bytes) > self.slot_size:
+            raise ValueError("The entry does not fit a {} byte slot.".format(self.slot_size))
+        key_hash = self._hash(key_bytes)
+        now = time.time()
+        with self._locked():
+            window = self._window(key_hash)
+            self._repair(window)
+            target = None
+            for slot in window:
+                _, state, slot_hash, expires, _, _, _ = self.SLOT.unpack_from(self.map, self._offset(slot))
+                if self._read(slot, key_bytes, key_hash) is not None:
+                    target = slot
+                    break
+                if target is None and (state != self.USED or (expires and expires <= now)):
+                    target = slot
+                if state == self.EMPTY:
+                    break
+            if target is None:
+                self.evictions += 1
+            else:
+                state, expires = self.SLOT.unpack_from(self.map, self._offset(target))[1:4:2]
+                if state == self.USED and expires and expires <= now and self._read(target, key_bytes, key_hash) is None:
+                    self.expirations += 1
+            self._write_slot(
+                window[0] if target is None else target, self.USED, key_hash,
+                now + ttl if ttl is not None else 0.0, now + stale_after if stale_after is not None else 0.0,
+                key_bytes, value_bytes)
+
+    def delete(self, key):
+        with self._locked():
+            slot, _ = self._lookup(key, locked=True)
+            if slot is None:
+                return False
+            self._write_slot(slot, self.DELETED)
+            return True
+
+    def clear(self):
+        with self._locked():
+            self._repair(range(self.slots))
+            for slot in range(self.slots):
+                if self.SLOT.unpack_from(self.map, self._offset(slot))[1] != self.EMPTY:
+                    self._write_slot(slot, self.EMPTY)
+
+    @property
+    def nbytes(self):
+        return len(self.map)
+
+    def __len__(self):
+        now = time.time()
+        count = 0
+        for slot in range(self.slots):
+            _, state, _, expires, _, _, _ = self.SLOT.unpack_from(self.map, self._offset(slot))
+            if state == self.USED and not (expires and expires <= now):
+                count += 1
+        return count
+
+    def close(self):
+        self.view.release()
+        self.map.close()
+        os.close(self.fd)
+
+
+class LatencyHistogram(object):
+    """
+    Latencies counted in exponential buckets from 1 microsecond up to about 16 seconds.
+    Quantiles are estimated as the upper bound of the bucket they fall in.
+    """
+    BOUNDS = [1e-6 * 2 ** i for i in range(25)]
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.buckets = [0] * (len(self.BOUNDS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        with self.lock:
+            self.buckets[bisect.bisect_left(self.BOUNDS, seconds)] += 1
+            self.count += 1
+            self.sum += seconds
+
+    def quantile(self, q):
+        with self.lock:
+            rank = q * self.count
+            seen = 0
+            for bound, count in zip(self.BOUNDS + [math.inf], self.buckets):
+                seen += count
+                if count and seen >= rank:
+                    return bound
+        return None
+
+    def snapshot(self):
+        return {'count': self.count, 'sum': self.sum, 'p50': self.quantile(0.5), 'p99': self.quantile(0.99)}
+
+
+class BackingStore(metaclass=abc.ABCMeta):
+    """
+    Where the cache reads misses from and writes dirty entries back to.
+    """
+
+    @abc.abstractmethod
+    def load(self, key):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def store_many(self, items):
+        raise NotImplementedError
+
+
+class DictStore(BackingStore):
+
+    def __init__(self, data=None):
+        self.data = dict(data or {})
+        self.lock = threading.Lock()
+
+    def load(self, key):
+        with self.lock:
+            return self.data.get(key)
+
+    def store_many(self, items):
+        with self.lock:
+            self.data.update(items)
+
+
+class SQLiteStore(BackingStore):
+    """
+    Pickled values in a key value table of an SQLite database, in memory by default.
+    """
+
+    def __init__(self, path=':memory:'):
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS cache (key BLOB PRIMARY KEY, value BLOB)')
+        self.lock = threading.Lock()
+
+    def load(self, key):
+        with self.lock:
+            row = self.connection.execute('SELECT value FROM cache WHERE key = ?', (pickle.dumps(key),)).fetchone()
+        return pickle.loads(row[0]) if row is not None else None
+
+    def store_many(self, items):
+        rows = [(pickle.dumps(key), pickle.dumps(value)) for key, value in items.items()]
+        with self.lock, self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO cache (key, value) VALUES (?, ?)', rows)
+
+
+class ShardedCache(object):
+    """
+    In-process key value cache with LRU and TTL eviction. Keys are spread over `shards` independently
+    locked shards so that threads working on different keys rarely wait for each other.
+    max_entries and max_bytes are split evenly over the shards; sizes are estimated with sys.getsizeof.
+
+    With a loader (or a backing store to load from), load() reads misses through: concurrent misses on
+    a key share a single call of the loader, and values older than refresh_after seconds are served
+    stale while they are reloaded in the background. write() marks entries dirty for the store; they
+    are written behind in batches every flush_interval seconds, or as soon as flush_batch are pending.
+
+    With shared_path, the entries are kept in a SharedMemoryShard at that path instead, one cache for
+    all the processes of the host using the same path. Its size is set by shared_slots and shared_slot_size.
+
+    Hits, misses, evictions, expirations and loads are always counted. The latency of one operation in
+    every sample_every is recorded in a histogram per operation (None records none).
+    """
+    OPERATIONS = ('get', 'set', 'delete', 'load')
+
+    def __init__(self, shards=16, max_entries=None, max_bytes=None, ttl=None,
+                 loader=None, refresh_after=None, store=None, flush_interval=1.0, flush_batch=1000,
+                 shared_path=None, shared_slots=4096, shared_slot_size=512, sample_every=128):
+        self.sample_every = sample_every
+        self.countdown = sample_every or math.inf
+        self.latency = {operation: LatencyHistogram() for operation in self.OPERATIONS}
+        self.loads = 0
+        self.load_failures = 0
+        self.flush_failures = 0
+        self.ttl = ttl
+        self.loader = loader or (store.load if store is not None else None)
+        self.refresh_after = refresh_after
+        self.store = store
+        self.flush_interval = flush_interval
+        self.flush_batch = flush_batch
+        self.inflight = {}
+        self.inflight_lock = threading.Lock()
+        self.refresher = None
+        self.dirty = {}
+        self.dirty_lock = threading.Condition()
+        self.flusher = None
+        self.closed = False
+        self.shards = [
+            CacheShard(
+                max(1, max_entries // shards) if max_entries is not None else None,
+                max(1, max_bytes // shards) if max_bytes is not None else None)
+            for _ in range(shards)
+        ] if shared_path is None else [SharedMemoryShard(shared_path, shared_slots, shared_slot_size)]
+
+    def shard(self, key):
+        return self.shards[hash(key) % len(self.shards)]
+
+    def _timed(self, operation, function, *args):
+        # The operations count down to the next sample inline, as a method call would cost more than the
+        # sampling saves. The countdown is not thread-safe on purpose: a lost decrement only shifts which
+        # operation gets timed.
+        self.countdown = self.sample_every
+        start = time.perf_counter()
+        try:
+            return function(*args)
+        finally:
+            self.latency[operation].observe(time.perf_counter() - start)
+
+    def get(self, key, default=None):
+        self.countdown -= 1
+        if self.countdown <= 0:
+            return self._timed('get', self.shard(key).get, key, default)
+        return self.shard(key).get(key, default)
+
+    def set(self, key, value, ttl=None):
+        ttl = ttl if ttl is not None else self.ttl
+        self.countdown -= 1
+        if self.countdown <= 0:
+            return self._timed('set', self.shard(key).set, key, value, ttl)
+        self.shard(key).set(key, value, ttl)
+
+    def delete(self, key):
+        self.countdown -= 1
+        if self.countdown <= 0:
+            return self._timed('delete', self.shard(key).delete, key)
+        return self.shard(key).delete(key)
+
+    def clear(self):
+        for shard in self.shards:
+            shard.clear()
+
+    def load(self, key):
+        """
+        The cached value of the key, loading it on a miss.
+        """
+        self.countdown -= 1
+        if self.countdown <= 0:
+            return self._timed('load', self._read_through, key)
+        return self._read_through(key)
+
+    def _read_through(self, key):
+        return self._serve(key, self.shard(key).get_entry(key))
+
+    def _serve(self, key, entry):
+        # The entry comes from the one counted lookup of the read.
+        if entry is None:
+            return self._load(key)
+        value, stale = entry
+        if stale:
+            with self.inflight_lock:
+                if key not in self.inflight:
+                    if self.refresher is None:
+                        self.refresher = ThreadPoolExecutor(max_workers=4, thread_name_prefix='CacheRefresh')
+                    self.refresher.submit(self._load, key)
+        return value
+
+    async def aload(self, key):
+        # Only a miss waits for the loader in the executor, a stale value is served at once while refreshing.
+        entry = self.shard(key).get_entry(key)
+        if entry is not None:
+            return self._serve(key, entry)
+        return await asyncio.get_running_loop().run_in_executor(None, self._load, key)
+
+    def _load(self, key):
+        # Single flight: the first caller loads, everybody else missing the same key waits for its result.
+        with self.inflight_lock:
+            future = self.inflight.get(key)
+            leader = future is None
+            if leader:
+                # A load that finished since our miss has already filled the cache.
+                entry = self.shard(key).get_entry(key, count=False)
+                if entry is not None and not entry[1]:
+                    return entry[0]
+                future = self.inflight[key] = Future()
+        if not leader:
+            return future.result()
+        try:
+            if self.loader is None:
+                raise KeyError(key)
+            value = self.loader(key)
+            self.shard(key).set(key, value, self.ttl, self.refresh_after)
+            future.set_result(value)
+            return value
+        except BaseException as e:
+            future.set_exception(e)
+            with self.inflight_lock:
+                self.load_failures += 1
+            raise
+        finally:
+            with self.inflight_lock:
+                self.loads += 1
+                del self.inflight[key]
+
+    def write(self, key, value, ttl=None):
+        """
+        Set the value and queue it to be written behind to the backing store.
+        """
+        if self.store is None:
+            raise ValueError("The cache has no backing store to write to.")
+        self.set(key, value, ttl)
+        with self.dirty_lock:
+            if self.closed:
+                raise ValueError("The cache has been closed.")
+            self.dirty[key] = value
+            if self.flusher is None:
+                self.flusher = threading.Thread(target=self._write_behind, name='CacheWriteBehind', daemon=True)
+                self.flusher.start()
+            if len(self.dirty) >= self.flush_batch:
+                self.dirty_lock.notify()
+
+    def flush(self):
+        """
+        Write the dirty entries to the store. When the store fails, the entries are queued again (unless
+        they have been written to since) and the error is raised.
+        """
+        with self.dirty_lock:
+            batch, self.dirty = self.dirty, {}
+        if not batch:
+            return
+        try:
+            self.store.store_many(batch)
+        except Exception:
+            with self.dirty_lock:
+                for key, value in batch.items():
+                    self.dirty.setdefault(key, value)
+            raise
+
+    def _write_behind(self):
+        while True:
+            with self.dirty_lock:
+                if not self.closed and len(self.dirty) < self.flush_batch:
+                    self.dirty_lock.wait(self.flush_interval)
+                closed = self.closed
+            try:
+                self.flush()
+            except Exception as e:
+                self.flush_failures += 1
+                print("Failed to write {} entries behind: {}".format(len(self.dirty), e))
+                if closed:
+                    return
+                # Back off for an interval before retrying, instead of hammering a failing store.
+                with self.dirty_lock:
+                    if not self.closed:
+                        self.dirty_lock.wait(self.flush_interval)
+                continue
+            if closed:
+                return
+
+    def close(self):
+        """
+        Stop the background work, writing whatever is still dirty. Raises if the store still fails.
+        """
+        with self.dirty_lock:
+            self.closed = True
+            self.dirty_lock.notify()
+        if self.flusher is not None:
+            self.flusher.join()
+        if self.store is not None:
+            self.flush()
+        if self.refresher is not None:
+            self.refresher.shutdown()
+        for shard in self.shards:
+            if isinstance(shard, SharedMemoryShard):
+                shard.close()
+
+    @property
+    def nbytes(self):
+        return sum(shard.nbytes for shard in self.shards)
+
+    def __len__(self):
+        return sum(len(shard) for shard in self.shards)
+
+    def snapshot(self):
+        counters = {
+            name: sum(getattr(shard, name) for shard in self.shards)
+            for name in ('hits', 'misses', 'evictions', 'expirations')
+        }
+        lookups = counters['hits'] + counters['misses']
+        counters.update(
+            loads=self.loads,
+            load_failures=self.load_failures,
+            flush_failures=self.flush_failures,
+            entries=len(self),
+            bytes=self.nbytes,
+            hit_ratio=counters['hits'] / lookups if lookups else None,
+            latency={operation: histogram.snapshot() for operation, histogram in self.latency.items()},
+        )
+        return counters
+
+    def prometheus(self, prefix='cache'):
+        """
+        The snapshot in the Prometheus text exposition format.
+        """
+        snapshot = self.snapshot()
+        lines = []
+        for name, kind in (('hits', 'counter'), ('misses', 'counter'), ('evictions', 'counter'),
+                           ('expirations', 'counter'), ('loads', 'counter'), ('load_failures', 'counter'),
+                           ('flush_failures', 'counter'), ('entries', 'gauge'), ('bytes', 'gauge')):
+            metric = '{}_{}{}'.format(prefix, name, '_total' if kind == 'counter' else '')
+            lines.append('# TYPE {} {}'.format(metric, kind))
+            lines.append('{} {}'.format(metric, snapshot[name]))
+        metric = '{}_operation_seconds'.format(prefix)
+        lines.append('# TYPE {} histogram'.format(metric))
+        for operation, histogram in self.latency.items():
+            with histogram.lock:
+                buckets, count, total = list(histogram.buckets), histogram.count, histogram.sum
+            cumulative = 0
+            for bound, bucket in zip(histogram.BOUNDS + [math.inf], buckets):
+                cumulative += bucket
+                le = '+Inf' if bound == math.inf else repr(bound)
+                lines.append('{}_bucket{{operation="{}",le="{}"}} {}'.format(metric, operation, le, cumulative))
+            lines.append('{}_sum{{operation="{}"}} {}'.format(metric, operation, total))
+            lines.append('{}_count{{operation="{}"}} {}'.format(metric, operation, count))
+        return '\n'.join(lines) + '\n'
+
+
+class Cache(ShardedCache):
     __instance = None
+    __lock = threading.Lock()
 
     @staticmethod
-    def get_instance():
+    def get_instance(**options):
+        """
+        The cache, created with the given options on the first call. Later options are ignored.
+        """
         if Cache.__instance is None:
-            Cache()
+            with Cache.__lock:
+                # Checked again under the lock: another thread may have created it in the meantime.
+                if Cache.__instance is None:
+                    Cache(**options)
         return Cache.__instance
 
-    def __init__(self):
+    def __init__(self, **options):
         if Cache.__instance is not None:
             raise ReferenceError('Cannot instantiate a singleton class.')
         else:
+            super().__init__(**options)
             Cache.__instance = self
 
 
+class MetricsHandler(BaseHTTPRequestHandler):
+    """
+    Serves /metrics in the Prometheus text format and /metrics.json as JSON for server.cache.
+    """
+
+    def do_GET(self):
+        if self.path == '/metrics':
+            body, content_type = self.server.cache.prometheus(), 'text/plain; version=0.0.4'
+        elif self.path == '/metrics.json':
+            body, content_type = json.dumps(self.server.cache.snapshot()), 'application/json'
+        else:
+            self.send_error(404)
+            return
+        body = body.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_metrics(cache, host='127.0.0.1', port=0):
+    """
+    Start serving the metrics of the cache on a background thread. Port 0 picks a free port,
+    see server.server_address. Stop it with server.shutdown().
+    """
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.cache = cache
+    threading.Thread(target=server.serve_forever, name='CacheMetrics', daemon=True).start()
+    return server
+
+
+class _BareShard(CacheShard):
+    """
+    A CacheShard counting nothing.
+    """
+
+    def get_entry(self, key, count=True):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            value, expires, _, stale_at = entry
+            now = time.monotonic()
+            if expires is not None and expires <= now:
+                self._remove(key)
+                return None
+            self.entries.move_to_end(key)
+            return value, stale_at is not None and stale_at <= now
+
+
+class _BareCache(ShardedCache):
+    """
+    A ShardedCache without counters or latency sampling, the baseline of benchmark_instrumentation.
+    """
+
+    def __init__(self, shards=16):
+        super().__init__(shards=shards, sample_every=None)
+        self.shards = [_BareShard() for _ in range(shards)]
+
+    def get(self, key, default=None):
+        return self.shard(key).get(key, default)
+
+
+def benchmark_instrumentation(operations=200000, keys=1000, rounds=10):
+    """
+    Single-threaded get throughput of a cache without any instrumentation, with counters only, with the
+    default sampling and timing everything. The configurations take turns so that they all see the same
+    machine load.
+    """
+    caches = {
+        'no instrumentation': _BareCache(),
+        'counters, no sampling': ShardedCache(sample_every=None),
+        'counters, sampling every 128 gets': ShardedCache(sample_every=128),
+        'counters, timing every get': ShardedCache(sample_every=1),
+    }
+    best = dict.fromkeys(caches, math.inf)
+    for _ in range(rounds):
+        for name, cache in caches.items():
+            get = cache.get
+            for key in range(keys):
+                cache.set(key, key)
+            elapsed = timeit.timeit(lambda: [get(i % keys) for i in range(operations)], number=1)
+            best[name] = min(best[name], elapsed)
+    baseline = best['no instrumentation']
+    for name, elapsed in best.items():
+        print("{}: {:.0f} gets/s, {:+.1f}% time against no instrumentation".format(
+            name, operations / elapsed, (elapsed / baseline - 1) * 100))
+
+
+def benchmark_cache(threads=(1, 2, 4, 8), shards=(1, 16), operations=200000, keys=10000):
+    """
+    Every thread reads keys of which half are cached, refilling the misses.
+    """
+    for shard_count in shards:
+        for thread_count in threads:
+            cache = ShardedCache(shards=shard_count, max_entries=keys)
+            for key in range(0, keys, 2):
+                cache.set(key, key)
+            hits = [0] * thread_count
+
+            def work(n):
+                for i in range(operations // thread_count):
+                    key = (i * 7919 + n) % keys
+                    if cache.get(key) is None:
+                        cache.set(key, key)
+                    else:
+                        hits[n] += 1
+
+            workers = [threading.Thread(target=work, args=(n,)) for n in range(thread_count)]
+            start = time.perf_counter()
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            elapsed = time.perf_counter() - start
+            print("{:>2} shards, {} threads: {:.0f} ops/s, {} hits".format(
+                shard_count, thread_count, operations / elapsed, sum(hits)))
+
+
+def _shared_worker(path, worker):
+    cache = ShardedCache(shared_path=path)
+    for i in range(100):
+        cache.set('worker {} key {}'.format(worker, i), os.getpid())
+    return cache.get('worker 0 key 0')
+
+
 if __name__ == '__main__':
     print(Cache.get_instance())
     print(Cache.get_instance())
+    cache = Cache.get_instance()
+    cache.set('answer', 42)
+    cache.set('session', 'expires', ttl=0.01)
+    time.sleep(0.02)
+    print(cache.get('answer'), cache.get('session'))
+    server = serve_metrics(cache)
+    url = 'http://{}:{}'.format(*server.server_address)
+    print(json.loads(urllib.request.urlopen(url + '/metrics.json').read()))
+    print(urllib.request.urlopen(url + '/metrics').read().decode('utf-8').splitlines()[:4])
+    server.shutdown()
+    benchmark_instrumentation()
+    benchmark_cache()
+    print("--- Read through / write behind ---")
+    store = SQLiteStore()
+    store.store_many({'report': 'v1'})
+    loads = []
+
+    def slow_loader(key):
+        loads.append(key)
+        time.sleep(0.05)
+        return store.load(key)
+
+    backed = ShardedCache(loader=slow_loader, refresh_after=1.0, store=store, flush_interval=0.05)
+    callers = [threading.Thread(target=backed.load, args=('report',)) for _ in range(1000)]
+    for caller in callers:
+        caller.start()
+    for caller in callers:
+        caller.join()
+    print("1000 concurrent misses, {} load(s)".format(len(loads)))
+    store.store_many({'report': 'v2'})
+    time.sleep(1.0)
+    print("Stale value served: {}".format(backed.load('report')))
+    time.sleep(0.1)
+    print("Refreshed value: {}, loads: {}".format(backed.load('report'), len(loads)))
+    backed.write('summary', 'written behind')
+    print("In the store right after the write: {}".format(store.load('summary')))
+    time.sleep(0.1)
+    print("In the store after the flush interval: {}".format(store.load('summary')))
+
+    async def many_async_loads():
+        return await asyncio.gather(*[backed.aload('other') for _ in range(100)])
+
+    print("100 async loads of a missing key: {} value(s), loads: {}".format(
+        len(set(asyncio.run(many_async_loads()))), len(loads)))
+    backed.close()
+    print("--- Shared between processes ---")
+    shared_path = os.path.join(tempfile.mkdtemp(), 'cache')
+    shared = ShardedCache(shared_path=shared_path)
+    shared.set('worker 0 key 0', 'set by the parent')
+    with multiprocessing.Pool(4) as pool:
+        print("Workers read: {}".format(set(pool.starmap(_shared_worker, [(shared_path, n) for n in range(1, 5)]))))
+    print("The parent sees {} entries in a {} byte file, one written by pid {}".format(
+        len(shared), shared.nbytes, shared.get('worker 3 key 99')))
+    print("Unpickled straight from the shared memory: {!r}".format(pickle.loads(shared.shards[0].view_entry('worker 0 key 0'))))
+    shared.close()
+    os.remove(shared_path)
     print(Cache())
@@ -0,0 +1,137 @@
+"""
+Read through and write behind of the ShardedCache, against the in-memory stand-ins for a backing store.
+"""
+
+import asyncio
+import threading
+import time
+import unittest
+
+from creational.singleton import DictStore, SQLiteStore, ShardedCache
+
+
+class FlakyStore(DictStore):
+    """
+    A store failing its first `failures` writes.
+    """
+
+    def __init__(self, failures):
+        super().__init__()
+        self.failures = failures
+
+    def store_many(self, items):
+        if self.failures:
+            self.failures -= 1
+            raise IOError("store unavailable")
+        super().store_many(items)
+
+
+class ReadThroughTest(unittest.TestCase):
+
+    def test_concurrent_misses_load_once(self):
+        loads = []
+
+        def loader(key):
+            loads.append(key)
+            time.sleep(0.05)
+            return key.upper()
+
+        cache = ShardedCache(loader=loader)
+        results = []
+        callers = [threading.Thread(target=lambda: results.append(cache.load('report'))) for _ in range(50)]
+        for caller in callers:
+            caller.start()
+        for caller in callers:
+            caller.join()
+        self.assertEqual(loads, ['report'])
+        self.assertEqual(results, ['REPORT'] * 50)
+
+    def test_loads_from_the_store(self):
+        store = SQLiteStore()
+        store.store_many({'report': 'v1'})
+        cache = ShardedCache(store=store)
+        self.assertEqual(cache.load('report'), 'v1')
+        self.assertEqual(cache.loads, 1)
+
+    def test_stale_value_is_served_while_refreshing(self):
+        store = DictStore({'report': 'v1'})
+        cache = ShardedCache(store=store, refresh_after=0.01)
+        self.assertEqual(cache.load('report'), 'v1')
+        store.store_many({'report': 'v2'})
+        time.sleep(0.02)
+        self.assertEqual(cache.load('report'), 'v1')
+        cache.refresher.shutdown()
+        self.assertEqual(cache.load('report'), 'v2')
+
+    def test_aload(self):
+        cache = ShardedCache(store=DictStore({'report': 'v1'}))
+
+        async def load_many():
+            return await asyncio.gather(*[cache.aload('report') for _ in range(10)])
+
+        self.assertEqual(asyncio.run(load_many()), ['v1'] * 10)
+        self.assertEqual(cache.loads, 1)
+        self.assertEqual(asyncio.run(cache.aload('report')), 'v1')
+        snapshot = cache.snapshot()
+        # One counted lookup per read, whether it hit or waited for the load.
+        self.assertEqual(snapshot['hits'] + snapshot['misses'], 11)
+
+
+class WriteBehindTest(unittest.TestCase):
+
+    def test_writes_reach_the_store(self):
+        store = SQLiteStore()
+        cache = ShardedCache(store=store, flush_interval=0.01)
+        cache.write('summary', 'written behind')
+        self.assertEqual(cache.get('summary'), 'written behind')
+        time.sleep(0.1)
+        self.assertEqual(store.load('summary'), 'written behind')
+        cache.close()
+
+    def test_full_batch_is_written_right_away(self):
+        store = DictStore()
+        cache = ShardedCache(store=store, flush_interval=60, flush_batch=10)
+        for i in range(10):
+            cache.write(i, i)
+        time.sleep(0.1)
+        self.assertEqual(len(store.data), 10)
+        cache.close()
+
+    def test_failed_batch_is_retried(self):
+        store = FlakyStore(failures=2)
+        cache = ShardedCache(store=store, flush_interval=0.01)
+        cache.write('summary', 'v1')
+        time.sleep(0.1)
+        self.assertEqual(cache.flush_failures, 2)
+        self.assertTrue(cache.flusher.is_alive())
+        self.assertEqual(store.load('summary'), 'v1')
+        cache.write('summary', 'v2')
+        cache.close()
+        self.assertEqual(store.load('summary'), 'v2')
+
+    def test_newer_write_wins_over_failed_batch(self):
+        store = FlakyStore(failures=1)
+        cache = ShardedCache(store=store, flush_interval=60)
+        cache.write('summary', 'v1')
+        with self.assertRaises(IOError):
+            cache.flush()
+        cache.write('summary', 'v2')
+        cache.close()
+        self.assertEqual(store.load('summary'), 'v2')
+
+    def test_close_raises_when_the_store_still_fails(self):
+        cache = ShardedCache(store=FlakyStore(failures=100), flush_interval=60)
+        cache.write('summary', 'v1')
+        with self.assertRaises(IOError):
+            cache.close()
+        self.assertEqual(cache.dirty, {'summary': 'v1'})
+
+    def test_write_without_store(self):
+        cache = ShardedCache()
+        with self.assertRaises(ValueError):
+            cache.write('summary', 'v1')
+        self.assertIsNone(cache.get('summary'))
+
+
+if __name__ == '__main__':
+    unittest.main()